@@ -0,0 +1,120 @@
+import itertools
+import json
+import re
+import threading
+import time
+
+from types import SimpleNamespace
+
+
+_POST_ID_PATTERN = re.compile(r"\"ID\": \"(\d+)\"")
+
+
+def _get_usage(user_message: str) -> SimpleNamespace:
+    prompt_tokens = len(user_message) // 4
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=prompt_tokens // 10,
+                           total_tokens=prompt_tokens + prompt_tokens // 10)
+
+
+def _get_answer(user_message: str, posts_per_topic: int) -> str:
+    # Every few posts of the batch become one topic, in the format the instructions ask for
+    post_ids = _POST_ID_PATTERN.findall(user_message)
+    topics = []
+    for index in range(0, len(post_ids), posts_per_topic):
+        topics.append({"TOPIC_TITLE": f"Topic {post_ids[index]}", "TOPIC_SUMMARY": "Synthetic summary",
+                       "TOPIC_ANALYSIS": "Synthetic analysis", "TOPIC_RATING": str(1 + index % 5),
+                       "POST_IDs": ",".join(post_ids[index:index + posts_per_topic])})
+    return "```json" + json.dumps(topics) + "```"
+
+
+class _Run:
+    def __init__(self, run_id: str, thread_id: str, latency: float):
+        self.id = run_id
+        self.thread_id = thread_id
+        self.created = time.monotonic()
+        self.finished = self.created + latency
+
+
+class FakeOpenAiClient:
+    # Mimics the parts of the assistants/threads/runs and chat completions APIs OpenAiService uses.
+    # Runs complete after the configured latency, the durations are recorded for the reports.
+    def __init__(self, latency: float = 0.5, posts_per_topic: int = 3):
+        self.latency = latency
+        self.posts_per_topic = posts_per_topic
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.messages_by_thread_id = {}
+        self.runs_by_id = {}
+        self.run_durations = []
+        self.number_of_requests = 0
+
+        self.beta = SimpleNamespace(
+            assistants=SimpleNamespace(create=self._create_assistant, update=self._update_assistant),
+            threads=SimpleNamespace(
+                create=self._create_thread,
+                messages=SimpleNamespace(create=self._create_message, list=self._list_messages),
+                runs=SimpleNamespace(create=self._create_run, retrieve=self._retrieve_run)))
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_chat_completion))
+
+    def _get_id(self, prefix: str) -> str:
+        with self.lock:
+            self.number_of_requests += 1
+            return f"{prefix}_{next(self.ids)}"
+
+    def _add_run_duration(self, duration: float):
+        with self.lock:
+            self.run_durations.append(duration)
+
+    def _create_assistant(self, **kwargs) -> SimpleNamespace:
+        return SimpleNamespace(id=self._get_id("asst"))
+
+    def _update_assistant(self, assistant_id: str, **kwargs) -> SimpleNamespace:
+        self._get_id("asst")
+        return SimpleNamespace(id=assistant_id)
+
+    def _create_thread(self, **kwargs) -> SimpleNamespace:
+        return SimpleNamespace(id=self._get_id("thread"))
+
+    def _create_message(self, thread_id: str, content: str, role: str, **kwargs) -> SimpleNamespace:
+        self.messages_by_thread_id[thread_id] = content
+        return SimpleNamespace(id=self._get_id("msg"))
+
+    def _list_messages(self, thread_id: str, **kwargs) -> SimpleNamespace:
+        self._get_id("list")
+        text = SimpleNamespace(value=_get_answer(self.messages_by_thread_id[thread_id], self.posts_per_topic))
+        return SimpleNamespace(data=[SimpleNamespace(content=[SimpleNamespace(text=text)])])
+
+    def _create_run(self, thread_id: str, assistant_id: str, stream: bool = False, **kwargs):
+        run = _Run(self._get_id("run"), thread_id, self.latency)
+        if stream:
+            return self._stream_run(run)
+        self.runs_by_id[run.id] = run
+        return SimpleNamespace(id=run.id, status="queued")
+
+    def _stream_run(self, run: _Run):
+        yield SimpleNamespace(event="thread.run.created", data=SimpleNamespace(status="queued"))
+        time.sleep(max(run.finished - time.monotonic(), 0.0))
+        self._add_run_duration(time.monotonic() - run.created)
+        yield SimpleNamespace(event="thread.run.completed",
+                              data=SimpleNamespace(status="completed",
+                                                   usage=_get_usage(self.messages_by_thread_id[run.thread_id])))
+
+    def _retrieve_run(self, run_id: str, thread_id: str, **kwargs) -> SimpleNamespace:
+        self._get_id("retrieve")
+        run = self.runs_by_id.get(run_id)
+        if run is not None:
+            if time.monotonic() < run.finished:
+                return SimpleNamespace(id=run_id, status="in_progress", usage=None)
+            del self.runs_by_id[run_id]
+            self._add_run_duration(time.monotonic() - run.created)
+        return SimpleNamespace(id=run_id, status="completed",
+                               usage=_get_usage(self.messages_by_thread_id[thread_id]))
+
+    def _create_chat_completion(self, model: str, messages: list[dict], **kwargs) -> SimpleNamespace:
+        self._get_id("chat")
+        started = time.monotonic()
+        time.sleep(self.latency)
+        self._add_run_duration(time.monotonic() - started)
+        user_message = messages[-1]["content"]
+        message = SimpleNamespace(content=_get_answer(user_message, self.posts_per_topic))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=_get_usage(user_message))
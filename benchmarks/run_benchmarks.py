@@ -0,0 +1,183 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timezone
+
+from benchmarks.fake_openai import FakeOpenAiClient
+from benchmarks.synthetic_feeds import FeedServer, generate_feeds
+from model.area import Area, COMPLETION_MODES
+from model.rss_feed import RssFeed
+from services.config_service import ConfigService
+from services.database_service import DatabaseService
+from services.openai_service import OpenAiService
+from services.rss_feed_service import RssFeedService
+
+
+def _get_percentiles(values: list[float]) -> dict[str, float]:
+    # Nearest rank, which stays meaningful for the small samples of the slow paths
+    if len(values) < 1:
+        return {}
+    values = sorted(values)
+    percentiles = {}
+    for percentile in (50, 95, 99):
+        rank = max(1, -(-percentile * len(values) // 100))
+        percentiles[f"p{percentile}"] = round(values[rank - 1], 6)
+    percentiles["max"] = round(values[-1], 6)
+    return percentiles
+
+
+def _get_config(directory: str, arguments: argparse.Namespace) -> ConfigService:
+    config_service = ConfigService()
+    config_service.database_filename = os.path.join(directory, "benchmark.sqlite3")
+    config_service.database_archive_filename = os.path.join(directory, "benchmark_archive.sqlite3")
+    config_service.areas_filename = os.path.join(directory, "areas.json")
+    # The fake answers without a quota, the rate limit would only measure itself
+    config_service.openai_requests_per_minute = 1_000_000
+    config_service.openai_poll_initial_interval = arguments.poll_interval
+    return config_service
+
+
+def _benchmark_ingestion(database_service: DatabaseService, config_service: ConfigService) -> dict:
+    rss_feed_service = RssFeedService(database_service=database_service, config_service=config_service)
+    start = time.perf_counter()
+    number_of_new_posts = rss_feed_service.add_latest_posts()
+    seconds = time.perf_counter() - start
+
+    # The second run only sees unchanged feeds, which is what most runs in production look like
+    start = time.perf_counter()
+    rss_feed_service.add_latest_posts()
+    unchanged_seconds = time.perf_counter() - start
+
+    return {"new_posts": number_of_new_posts, "seconds": round(seconds, 6),
+            "posts_per_second": round(number_of_new_posts / seconds, 2),
+            "unchanged_seconds": round(unchanged_seconds, 6)}
+
+
+def _benchmark_topics(database_service: DatabaseService, config_service: ConfigService,
+                      arguments: argparse.Namespace) -> dict:
+    area = database_service.get_enabled_areas()[0]
+    number_of_pending_posts = len(database_service.get_posts_by_area_without_topic(area.id))
+    client = FakeOpenAiClient(latency=arguments.latency)
+    openai_service = OpenAiService(database_service=database_service, config_service=config_service, client=client)
+
+    start = time.perf_counter()
+    openai_service.create_topics()
+    seconds = time.perf_counter() - start
+
+    return {"pending_posts": number_of_pending_posts,
+            "remaining_posts": len(database_service.get_posts_by_area_without_topic(area.id)),
+            "seconds": round(seconds, 6), "posts_per_second": round(number_of_pending_posts / seconds, 2),
+            "runs": len(client.run_durations), "api_requests": client.number_of_requests,
+            "run_seconds": _get_percentiles(client.run_durations)}
+
+
+def _benchmark_display_list(database_service: DatabaseService, config_service: ConfigService,
+                            arguments: argparse.Namespace) -> dict:
+    # Imported here, the web module configures logging and its services when it is loaded
+    import main_web
+
+    main_web.cfg_service.database_filename = config_service.database_filename
+    main_web.cfg_service.database_archive_filename = config_service.database_archive_filename
+    main_web.db_pool_service.close_all()
+    main_web.page_cache_service.clear()
+    client = main_web.app.test_client()
+
+    # Every page of the unread list is requested in turn, following the keyset pagination
+    page_size = main_web.cfg_service.web_topics_page_size
+    topics = database_service.get_topics_for_view(0)
+    urls = ["/list/0"] + [f"/list/0?after={topics[index - 1].id}" for index in range(page_size, len(topics), page_size)]
+
+    rendered_seconds = []
+    for request_index in range(arguments.requests):
+        main_web.page_cache_service.clear()
+        start = time.perf_counter()
+        response = client.get(urls[request_index % len(urls)])
+        rendered_seconds.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"Unexpected status {response.status_code} for {urls[request_index % len(urls)]}")
+
+    cached_seconds = []
+    for request_index in range(arguments.requests):
+        start = time.perf_counter()
+        client.get(urls[request_index % len(urls)])
+        cached_seconds.append(time.perf_counter() - start)
+
+    main_web.db_pool_service.close_all()
+    return {"pages": len(urls), "requests": arguments.requests,
+            "requests_per_second": round(arguments.requests / sum(rendered_seconds), 2),
+            "seconds": _get_percentiles(rendered_seconds), "cached_seconds": _get_percentiles(cached_seconds)}
+
+
+def _benchmark_size(number_of_posts: int, directory: str, arguments: argparse.Namespace) -> dict:
+    logging.warning(f"Benchmarking {number_of_posts} posts")
+    config_service = _get_config(directory, arguments)
+    instructions_filename = os.path.join(directory, "instructions.md")
+    with open(instructions_filename, 'w') as instructions_file:
+        instructions_file.write("Group the posts into topics.")
+
+    feeds_directory = os.path.join(directory, "feeds")
+    filenames = generate_feeds(feeds_directory, arguments.feeds, max(1, number_of_posts // arguments.feeds),
+                               seed=arguments.seed)
+
+    result = {"posts": number_of_posts}
+    with FeedServer(feeds_directory) as feed_server, DatabaseService(config_service) as database_service:
+        area = Area(name="Benchmark", title="Benchmark", instructions_filename=instructions_filename,
+                    model="fake", priority=1, completion_mode=arguments.completion_mode)
+        area.rss_feeds = [RssFeed(link=feed_server.get_url(filename)) for filename in filenames]
+        database_service.import_areas([area])
+
+        result["add_latest_posts"] = _benchmark_ingestion(database_service, config_service)
+        result["create_topics"] = _benchmark_topics(database_service, config_service, arguments)
+        result["display_list"] = _benchmark_display_list(database_service, config_service, arguments)
+
+    database_filenames = [config_service.database_filename, config_service.database_filename + "-wal"]
+    result["database_bytes"] = sum(os.path.getsize(filename) for filename in database_filenames
+                                   if os.path.exists(filename))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks ingestion, topic creation and the topic list "
+                                                 "against synthetic feeds and a fake OpenAI backend.")
+    parser.add_argument("--sizes", default="1000,5000,20000",
+                        help="comma separated numbers of posts, every size starts from an empty database")
+    parser.add_argument("--feeds", type=int, default=20, help="number of synthetic feeds")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds the fake takes for every run")
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="first polling interval of the runs")
+    parser.add_argument("--completion-mode", default="poll", choices=COMPLETION_MODES)
+    parser.add_argument("--requests", type=int, default=200, help="requests per topic list benchmark")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="file to write the JSON report to, standard output otherwise")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format=ConfigService().logging_format)
+
+    results = []
+    for number_of_posts in [int(size) for size in arguments.sizes.split(",")]:
+        with tempfile.TemporaryDirectory(prefix="mentalist_benchmark_") as directory:
+            results.append(_benchmark_size(number_of_posts, directory, arguments))
+
+    report = {
+        "created": datetime.now().astimezone(timezone.utc).isoformat(),
+        "environment": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                        "platform": platform.platform()},
+        "parameters": {key: value for key, value in vars(arguments).items() if key != "output"},
+        "results": results,
+    }
+    report_json = json.dumps(report, indent=2)
+    if arguments.output is None:
+        print(report_json)
+    else:
+        with open(arguments.output, 'w') as output_file:
+            output_file.write(report_json)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import os
+import random
+import threading
+
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+
+_SUBJECTS = ["Verstappen", "Hamilton", "Leclerc", "Norris", "Alonso", "Russell", "Piastri", "Sainz", "Perez",
+             "Red Bull", "Ferrari", "Mercedes", "McLaren", "Aston Martin", "Williams", "the FIA", "Formula 2"]
+_ACTIONS = ["wins", "crashes out of", "dominates", "struggles in", "is penalised after", "takes pole for",
+            "leads practice for", "retires from", "questions the rules of", "signs a new deal before"]
+_EVENTS = ["the Bahrain Grand Prix", "the Monaco Grand Prix", "the British Grand Prix", "the Italian Grand Prix",
+           "the Japanese Grand Prix", "the sprint race", "pre-season testing", "the season finale"]
+_FILLER = ["The team said", "According to sources in the paddock", "After the session", "Speaking to the media",
+           "In a statement", "Fans reacted as", "Analysts expect that", "It is understood that"]
+
+
+class _Story:
+    def __init__(self, story_id: int, title: str, summary: str, published: datetime):
+        self.id = story_id
+        self.title = title
+        self.summary = summary
+        self.published = published
+
+
+def _get_stories(rng: random.Random, number_of_stories: int, start: datetime) -> list[_Story]:
+    stories = []
+    for story_id in range(number_of_stories):
+        title = f"{rng.choice(_SUBJECTS)} {rng.choice(_ACTIONS)} {rng.choice(_EVENTS)}"
+        sentences = [f"{rng.choice(_FILLER)} {rng.choice(_SUBJECTS)} {rng.choice(_ACTIONS)} {rng.choice(_EVENTS)}."
+                     for _ in range(rng.randint(2, 6))]
+        stories.append(_Story(story_id, title, " ".join(sentences),
+                              start + timedelta(minutes=rng.randint(0, 14 * 24 * 60))))
+    return stories
+
+
+def _rss_item(link: str, title: str, summary: str, published: datetime) -> str:
+    return (f"<item><title>{escape(title)}</title><link>{escape(link)}</link>"
+            f"<description>{escape('<p>' + escape(summary) + '</p>')}</description>"
+            f"<pubDate>{format_datetime(published)}</pubDate></item>")
+
+
+def _atom_entry(link: str, title: str, summary: str, published: datetime) -> str:
+    return (f"<entry><title>{escape(title)}</title><link href=\"{escape(link)}\"/><id>{escape(link)}</id>"
+            f"<summary type=\"html\">{escape(summary)}</summary>"
+            f"<published>{published.isoformat()}</published><updated>{published.isoformat()}</updated></entry>")
+
+
+def generate_feeds(directory: str, number_of_feeds: int, posts_per_feed: int, duplicate_ratio: float = 0.3,
+                   seed: int = 42) -> list[str]:
+    # Every other feed is Atom. A share of the posts retell a story of another feed in slightly different words,
+    # so the near-duplicate detection and the clustering have something to find.
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    stories = _get_stories(rng, max(1, int(number_of_feeds * posts_per_feed * (1.0 - duplicate_ratio))), start)
+
+    filenames = []
+    for feed_index in range(number_of_feeds):
+        items = []
+        for post_index in range(posts_per_feed):
+            story = rng.choice(stories) if rng.random() < duplicate_ratio else stories[
+                (feed_index * posts_per_feed + post_index) % len(stories)]
+            link = f"https://feed{feed_index}.example.com/{story.id}/{post_index}"
+            title = story.title if rng.random() < 0.5 else f"{story.title} - {rng.choice(_FILLER).lower()}"
+            published = story.published + timedelta(minutes=rng.randint(0, 120))
+            if feed_index % 2 == 0:
+                items.append(_rss_item(link, title, story.summary, published))
+            else:
+                items.append(_atom_entry(link, title, story.summary, published))
+
+        if feed_index % 2 == 0:
+            filename = f"feed{feed_index}.xml"
+            content = (f"<?xml version=\"1.0\" encoding=\"utf-8\"?><rss version=\"2.0\"><channel>"
+                       f"<title>Synthetic feed {feed_index}</title><link>https://feed{feed_index}.example.com</link>"
+                       f"{''.join(items)}</channel></rss>")
+        else:
+            filename = f"feed{feed_index}.atom"
+            content = (f"<?xml version=\"1.0\" encoding=\"utf-8\"?><feed xmlns=\"http://www.w3.org/2005/Atom\">"
+                       f"<title>Synthetic feed {feed_index}</title>"
+                       f"<link href=\"https://feed{feed_index}.example.com\"/>"
+                       f"<id>https://feed{feed_index}.example.com</id><updated>{start.isoformat()}</updated>"
+                       f"{''.join(items)}</feed>")
+        with open(os.path.join(directory, filename), 'w', encoding='utf-8') as feed_file:
+            feed_file.write(content)
+        filenames.append(filename)
+    return filenames
+
+
+class _QuietRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class FeedServer:
+    # Serves the generated files on localhost, so the feeds go through the same HTTP code as real ones
+    def __init__(self, directory: str):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), partial(_QuietRequestHandler, directory=directory))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_url(self, filename: str) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/{filename}"
@@ -1,11 +1,16 @@
+import argparse
 import json
 
-from model.area import Area
+from model.area import Area, COMPLETION_MODES
 from model.rss_feed import RssFeed
 from services.config_service import ConfigService
 from services.database_service import DatabaseService
+from services.metrics_service import metrics_service
 from services.openai_service import OpenAiService
+from services.retention_service import RetentionService
 from services.rss_feed_service import RssFeedService
+from services.scheduler_service import SchedulerService
+from services.topic_matching_service import TopicMatchingService
 import logging
 
 
@@ -16,11 +21,17 @@ def load_areas_json() -> list[Area]:
         area_priority = 0
         for area_json in areas_json["areas"]:
             area_priority += 1
+            completion_mode = area_json.get("completion_mode", "poll")
+            if completion_mode not in COMPLETION_MODES:
+                raise ValueError(f"Unknown completion_mode \"{completion_mode}\" for area \"{area_json['name']}\" "
+                                 f"in \"{cfg_service.areas_filename}\", expected one of {', '.join(COMPLETION_MODES)}")
             area = Area(name=area_json["name"],
                         title=area_json["title"],
                         instructions_filename=area_json["instructions_filename"],
                         model=area_json["model"],
-                        priority=area_priority)
+                        priority=area_priority,
+                        completion_mode=completion_mode,
+                        batch_token_budget=area_json.get("batch_token_budget"))
             for rss_feed_json in area_json["rss_feeds"]:
                 area.rss_feeds.append(RssFeed(link=rss_feed_json))
             areas.append(area)
@@ -28,14 +39,36 @@ def load_areas_json() -> list[Area]:
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and fetch feeds and create topics when they are due")
+    args = parser.parse_args()
+
     cfg_service = ConfigService()
     logging.basicConfig(level=cfg_service.logging_level, format=cfg_service.logging_format)
 
     db_service = DatabaseService(cfg_service)
-    db_service.import_areas(load_areas_json())
+    rss_feed_service = RssFeedService(database_service=db_service, config_service=cfg_service)
+    topic_matching_service = TopicMatchingService(database_service=db_service, config_service=cfg_service)
+    openai_service = OpenAiService(database_service=db_service, config_service=cfg_service)
+    retention_service = RetentionService(database_service=db_service, config_service=cfg_service)
 
-    rss_feed_service = RssFeedService(db_service)
-    rss_feed_service.add_latest_posts()
+    if args.daemon:
+        scheduler_service = SchedulerService(database_service=db_service, config_service=cfg_service,
+                                             rss_feed_service=rss_feed_service,
+                                             topic_matching_service=topic_matching_service,
+                                             openai_service=openai_service, retention_service=retention_service,
+                                             load_areas=load_areas_json)
+        try:
+            scheduler_service.run()
+        except KeyboardInterrupt:
+            logging.info("Scheduler stopped")
+    else:
+        db_service.import_areas(load_areas_json())
+        rss_feed_service.add_latest_posts()
+        topic_matching_service.assign_posts_to_recent_topics()
+        openai_service.create_topics()
+        retention_service.archive_old_topics()
 
-    openai_service = OpenAiService(database_service=db_service, config_service=cfg_service)
-    openai_service.create_topics()
+    db_service.close()
+    logging.info(f"Metrics:\n{metrics_service.get_summary()}")
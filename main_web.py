@@ -1,41 +1,186 @@
+import atexit
 import logging
+import time
+
+from flask import Flask, render_template, redirect, url_for, g, request, jsonify, make_response
+from markupsafe import Markup, escape
+from werkzeug.http import is_resource_modified
 
-from flask import Flask, render_template, redirect, url_for
 from services.config_service import ConfigService
-from services.database_service import DatabaseService
+from services.database_pool_service import DatabasePoolService
+from services.database_service import DatabaseService, SEARCH_MATCH_START, SEARCH_MATCH_END
+from services.metrics_service import metrics_service
+from services.page_cache_service import PageCacheService
 
 app = Flask(__name__)
 
 cfg_service = ConfigService()
 logging.basicConfig(level=cfg_service.logging_level, format=cfg_service.logging_format)
 
+db_pool_service = DatabasePoolService(cfg_service)
+atexit.register(db_pool_service.close_all)
+
+page_cache_service = PageCacheService(cfg_service.web_page_cache_size)
+
+
+def get_db_service() -> DatabaseService:
+    if 'db_service' not in g:
+        g.db_service = db_pool_service.acquire()
+    return g.db_service
+
+
+@app.template_filter('highlight')
+def highlight(snippet: str) -> Markup:
+    return escape(snippet).replace(SEARCH_MATCH_START, Markup('<mark>')).replace(SEARCH_MATCH_END, Markup('</mark>'))
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request_time(response):
+    metrics_service.observe("mentalist_web_request_seconds", time.perf_counter() - g.request_start,
+                            endpoint=request.endpoint or "unknown", status=response.status_code)
+    return response
+
+
+@app.teardown_appcontext
+def release_db_service(exception):
+    db_service = g.pop('db_service', None)
+    if db_service is not None:
+        db_pool_service.release(db_service)
+
 
 @app.route('/')
 def index():
     return redirect(url_for('display_list', area_id=0))
 
 
-@app.route('/list/<area_id>')
+@app.route('/list/<int:area_id>')
 def display_list(area_id: int):
-    db_service = DatabaseService(cfg_service)
+    db_service = get_db_service()
+    after_topic_id = request.args.get('after', type=int)
+
+    # Every change shown on the page bumps the data version, so an unchanged version means an unchanged page
+    data_version, data_updated = db_service.get_data_version()
+    etag = str(data_version)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=data_updated):
+        response = make_response('', 304)
+    else:
+        cache_key = (area_id, after_topic_id, data_version)
+        page = page_cache_service.get(cache_key)
+        if page is None:
+            page = _render_list(db_service, area_id, after_topic_id)
+            page_cache_service.put(cache_key, page)
+        response = make_response(page)
+
+    response.set_etag(etag)
+    response.last_modified = data_updated
+    response.cache_control.no_cache = True
+    return response
+
+
+def _render_list(db_service: DatabaseService, area_id: int, after_topic_id: int | None) -> str:
     areas = db_service.get_areas_for_web()
-    topics = db_service.get_topics_for_view(area_id)
-    return render_template('index.html', areas=areas, topics=topics)
+    # One extra topic tells whether there is a next page
+    topics = db_service.get_topics_for_view(area_id, after_topic_id=after_topic_id,
+                                            limit=cfg_service.web_topics_page_size + 1)
+    next_topic_id = None
+    if len(topics) > cfg_service.web_topics_page_size:
+        topics = topics[:cfg_service.web_topics_page_size]
+        next_topic_id = topics[-1].id
+    with metrics_service.measure("mentalist_web_render_seconds", template='index.html'):
+        return render_template('index.html', areas=areas, topics=topics, area_id=area_id,
+                               next_topic_id=next_topic_id)
+
 
+@app.route('/topic_posts/<int:topic_id>')
+def topic_posts(topic_id: int):
+    db_service = get_db_service()
+    posts = db_service.get_posts_for_topic(topic_id)
+    return jsonify(posts=[{
+        'link': post.link,
+        'title': post.title,
+        'summary': post.summary,
+        'rss_feed_title': post.rss_feed.title if post.rss_feed is not None else None,
+        'rss_feed_web_link': post.rss_feed.web_link if post.rss_feed is not None else None
+    } for post in posts])
 
-@app.route('/topic_read/<area_id>/<topic_id>')
+
+@app.route('/topic_read/<int:area_id>/<int:topic_id>')
 def topic_read(area_id: int, topic_id: int):
-    db_service = DatabaseService(cfg_service)
+    db_service = get_db_service()
     db_service.toggle_topic_read(topic_id)
     return redirect(url_for('display_list', area_id=area_id))
 
 
-@app.route('/topic_save/<area_id>/<topic_id>')
+@app.route('/topic_save/<int:area_id>/<int:topic_id>')
 def topic_save(area_id: int, topic_id: int):
-    db_service = DatabaseService(cfg_service)
+    db_service = get_db_service()
     db_service.toggle_topic_saved(topic_id)
     return redirect(url_for('display_list', area_id=area_id))
 
 
+@app.route('/search')
+def search():
+    db_service = get_db_service()
+    query = request.args.get('q', '')
+    archive = request.args.get('scope', '') == 'archive'
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = cfg_service.web_search_page_size
+    # One extra result tells whether there is a next page
+    results = db_service.search(query, limit=page_size + 1, offset=(page - 1) * page_size, archive=archive)
+    has_next_page = len(results) > page_size
+    return render_template('search.html', areas=db_service.get_areas_for_web(), query=query,
+                           scope='archive' if archive else '', results=results[:page_size], page=page,
+                           has_next_page=has_next_page)
+
+
+@app.post('/api/topic_read/<int:topic_id>')
+def api_topic_read(topic_id: int):
+    db_service = get_db_service()
+    read = db_service.toggle_topic_read(topic_id)
+    if read is None:
+        return jsonify(error='Topic not found'), 404
+    return jsonify(id=topic_id, read=read, areas=_get_unread_topics_json(db_service))
+
+
+@app.post('/api/topic_save/<int:topic_id>')
+def api_topic_save(topic_id: int):
+    db_service = get_db_service()
+    saved = db_service.toggle_topic_saved(topic_id)
+    if saved is None:
+        return jsonify(error='Topic not found'), 404
+    return jsonify(id=topic_id, saved=saved, areas=_get_unread_topics_json(db_service))
+
+
+@app.post('/api/topics_read')
+def api_topics_read():
+    db_service = get_db_service()
+    request_json = request.get_json(silent=True)
+    topic_ids = request_json.get('topic_ids') if isinstance(request_json, dict) else None
+    # bool is a subclass of int, but true is no topic id
+    if not isinstance(topic_ids, list) or not all(isinstance(topic_id, int) and not isinstance(topic_id, bool)
+                                                  for topic_id in topic_ids):
+        return jsonify(error='topic_ids must be a list of topic ids'), 400
+    db_service.set_topics_read(topic_ids, read=True)
+    return jsonify(topic_ids=topic_ids, read=True, areas=_get_unread_topics_json(db_service))
+
+
+def _get_unread_topics_json(db_service: DatabaseService) -> list[dict]:
+    return [{'id': area.id, 'number_of_unread_topics': area.number_of_unread_topics}
+            for area in db_service.get_areas_for_web()]
+
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text exposition format, for this web process only
+    response = make_response(metrics_service.render_prometheus())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
 if __name__ == '__main__':
     app.run(debug=True)
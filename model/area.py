@@ -1,13 +1,25 @@
 from datetime import datetime
 
+from model.lazy_datetime import LazyDatetime
 from model.rss_feed import RssFeed
 
 
+COMPLETION_MODES = ("poll", "stream", "chat")
+
+
 class Area:
+    __slots__ = ("id", "name", "title", "instructions_filename", "model", "needs_code_interpreter", "needs_retrieval",
+                 "ai_id", "_ai_created", "_ai_last_update", "checksum", "priority", "enabled", "completion_mode",
+                 "batch_token_budget", "rss_feeds")
+
+    ai_created = LazyDatetime()
+    ai_last_update = LazyDatetime()
+
     def __init__(self, name: str, title: str, instructions_filename: str, model: str, priority: int,
                  area_id: int = None, needs_code_interpreter: bool = False, needs_retrieval: bool = False,
-                 ai_id: str = None, ai_created: datetime = None, ai_last_update: datetime = None, checksum: str = None,
-                 enabled: bool = True):
+                 ai_id: str = None, ai_created: datetime | str = None, ai_last_update: datetime | str = None,
+                 checksum: str = None, enabled: bool = True, completion_mode: str = "poll",
+                 batch_token_budget: int = None):
 
         self.id = area_id
         self.name = name
@@ -22,6 +34,8 @@ class Area:
         self.checksum = checksum
         self.priority = priority
         self.enabled = enabled
+        self.completion_mode = completion_mode
+        self.batch_token_budget = batch_token_budget
         self.rss_feeds = []
 
     def __str__(self):
@@ -1,9 +1,7 @@
-from datetime import datetime
-
-from model.rss_feed import RssFeed
-
 
 class AreaWeb:
+    __slots__ = ("id", "title", "number_of_unread_topics")
+
     def __init__(self, area_id: int, title: str, number_of_unread_topics: int):
         self.id = area_id
         self.title = title
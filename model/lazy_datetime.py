@@ -0,0 +1,19 @@
+from datetime import datetime
+
+
+class LazyDatetime:
+    # Dates read from the database stay text until they are used, most of them are never looked at
+    def __set_name__(self, owner, name):
+        self.attribute_name = f"_{name}"
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = getattr(instance, self.attribute_name)
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+            setattr(instance, self.attribute_name, value)
+        return value
+
+    def __set__(self, instance, value: datetime | str | None):
+        setattr(instance, self.attribute_name, value)
@@ -1,9 +1,17 @@
 from datetime import datetime, timezone
 
+from model.lazy_datetime import LazyDatetime
+
 
 class Post:
-    def __init__(self, link: str, title: str, summary: str, published: datetime, rss_feed_id: int, post_id: int = -1,
-                 created: datetime = None, ai_fileid: str = None, saved: bool = False):
+    __slots__ = ("id", "link", "title", "summary", "_published", "_created", "rss_feed_id", "ai_fileid", "saved",
+                 "rss_feed", "signature")
+
+    published = LazyDatetime()
+    created = LazyDatetime()
+
+    def __init__(self, link: str, title: str, summary: str, published: datetime | str, rss_feed_id: int,
+                 post_id: int = -1, created: datetime | str = None, ai_fileid: str = None, saved: bool = False):
 
         if created is None:
             created = datetime.now().astimezone(timezone.utc)
@@ -21,6 +29,7 @@ class Post:
         self.saved = saved
 
         self.rss_feed = None
+        self.signature = None
 
     def __str__(self):
         return f"[{self.id}] {self.title}"
@@ -1,15 +1,25 @@
 from datetime import datetime
 
+from model.lazy_datetime import LazyDatetime
+
 
 class RssFeed:
+    __slots__ = ("id", "link", "web_link", "title", "_last_update", "last_error", "etag", "modified", "content_hash")
+
+    last_update = LazyDatetime()
+
     def __init__(self, link: str, rss_feed_id: int = -1, web_link: str = None, title: str = None,
-                 last_update: datetime = None, last_error: str = None):
+                 last_update: datetime | str = None, last_error: str = None, etag: str = None, modified: str = None,
+                 content_hash: str = None):
         self.id = rss_feed_id
         self.link = link
         self.web_link = web_link
         self.title = title
         self.last_update = last_update
         self.last_error = last_error
+        self.etag = etag
+        self.modified = modified
+        self.content_hash = content_hash
 
     def __str__(self):
         return f"[{self.id}] {self.title}"
@@ -0,0 +1,22 @@
+from datetime import datetime
+
+from model.lazy_datetime import LazyDatetime
+
+
+class SearchResult:
+    __slots__ = ("kind", "id", "title", "snippet", "rank", "link", "_created")
+
+    created = LazyDatetime()
+
+    def __init__(self, kind: str, item_id: int, title: str, snippet: str, rank: float, link: str = None,
+                 created: datetime | str = None):
+        self.kind = kind
+        self.id = item_id
+        self.title = title
+        self.snippet = snippet
+        self.rank = rank
+        self.link = link
+        self.created = created
+
+    def __str__(self):
+        return f"[{self.kind} {self.id}] {self.title}"
@@ -1,9 +1,16 @@
 from datetime import datetime
 
+from model.lazy_datetime import LazyDatetime
+
 
 class Topic:
+    __slots__ = ("id", "area_id", "title", "summary", "_created", "my_rating", "ai_rating", "ai_analysis", "read",
+                 "saved", "posts")
+
+    created = LazyDatetime()
+
     def __init__(self, area_id: int, title: str, summary: str, ai_rating: int, ai_analysis: str,
-                 created: datetime, topic_id: int = None, my_rating: int = 0,
+                 created: datetime | str, topic_id: int = None, my_rating: int = 0,
                  read: bool = False, saved: bool = False):
         self.id = topic_id
         self.area_id = area_id
@@ -0,0 +1,69 @@
+import re
+import zlib
+
+import numpy as np
+
+from model.post import Post
+from services.config_service import ConfigService
+
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def _get_features(text: str) -> list[str]:
+    words = _WORD_PATTERN.findall(text.lower())
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+
+def _get_inverse_document_frequencies(term_frequencies: np.ndarray) -> np.ndarray:
+    document_frequencies = np.count_nonzero(term_frequencies, axis=0)
+    return (np.log((1.0 + len(term_frequencies)) / (1.0 + document_frequencies)) + 1.0).astype(np.float32)
+
+
+class ClusteringService:
+    def __init__(self, config_service: ConfigService):
+        self.config_service = config_service
+
+    def vectorize(self, texts: list[str], inverse_document_frequencies: np.ndarray = None) -> np.ndarray:
+        # Hashed TF-IDF over words and word pairs. Without given weights the IDF comes from the texts themselves.
+        term_frequencies = self._get_term_frequencies(texts)
+        if inverse_document_frequencies is None:
+            inverse_document_frequencies = _get_inverse_document_frequencies(term_frequencies)
+        # In place, a page of posts needs a single matrix
+        vectors = np.log1p(term_frequencies, out=term_frequencies)
+        vectors *= inverse_document_frequencies
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+    def get_inverse_document_frequencies(self, texts: list[str]) -> np.ndarray:
+        return _get_inverse_document_frequencies(self._get_term_frequencies(texts))
+
+    def _get_term_frequencies(self, texts: list[str]) -> np.ndarray:
+        # crc32 keeps the buckets stable between runs
+        dimensions = self.config_service.clustering_dimensions
+        term_frequencies = np.zeros((len(texts), dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in _get_features(text):
+                term_frequencies[row, zlib.crc32(feature.encode('utf-8')) % dimensions] += 1.0
+        return term_frequencies
+
+    def cluster_posts(self, posts: list[Post]) -> list[list[Post]]:
+        # Leader clustering: every post joins the first earlier post it is similar enough to
+        if len(posts) < 2:
+            return [[post] for post in posts]
+
+        vectors = self.vectorize([f"{post.title} {post.summary}" for post in posts])
+        similarities = vectors @ vectors.T
+        # A text without any word has a zero vector, it still has to form a cluster of its own
+        np.fill_diagonal(similarities, 1.0)
+        threshold = self.config_service.clustering_similarity_threshold
+
+        clusters = []
+        assigned = np.zeros(len(posts), dtype=bool)
+        for index in range(len(posts)):
+            if assigned[index]:
+                continue
+            members = np.flatnonzero(~assigned & (similarities[index] >= threshold))
+            assigned[members] = True
+            clusters.append([posts[member] for member in members])
+        return clusters
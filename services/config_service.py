@@ -12,7 +12,54 @@ class ConfigService:
         self.logging_format = '%(asctime)s - %(levelname)s - %(message)s'
 
         self.database_filename = ".\\mentalist.sqlite3"
+        self.database_busy_timeout = 5000
+        self.database_cache_size = 16384
+        self.database_pool_size = 4
+        self.database_archive_filename = ".\\mentalist_archive.sqlite3"
         self.areas_filename = ".\\areas.json"
         self.openai_api_key = os.environ.get('OPENAI_API_KEY')
 
-        self.openai_posts_batch_size = 80
+        self.openai_max_posts_per_batch = 200
+        self.openai_batch_token_budget = 12000
+        self.openai_chars_per_token = 4
+        self.openai_max_concurrent_runs = 4
+        self.openai_requests_per_minute = 60
+        self.openai_poll_initial_interval = 0.5
+        self.openai_poll_backoff_factor = 1.5
+        self.openai_poll_max_interval = 5.0
+        self.openai_response_cache_ttl_hours = 72
+        self.openai_response_cache_max_size = 10 * 1024 * 1024
+        self.openai_cluster_similar_posts = True
+
+        self.clustering_dimensions = 4096
+        self.clustering_similarity_threshold = 0.8
+
+        self.topic_matching_enabled = True
+        self.topic_matching_window_hours = 24
+        self.topic_matching_similarity_threshold = 0.5
+        self.topic_matching_page_size = 500
+
+        self.scheduler_tick_seconds = 60
+        self.scheduler_feed_min_interval_minutes = 15
+        self.scheduler_feed_max_interval_minutes = 360
+        self.scheduler_feed_interval_factor = 0.5
+        self.scheduler_feed_history_days = 14
+        self.scheduler_topics_min_pending_posts = 20
+        self.scheduler_topics_max_pending_age_minutes = 120
+
+        self.retention_enabled = False
+        self.retention_topic_days = 90
+        self.retention_interval_hours = 24
+
+        self.web_topics_page_size = 50
+        self.web_page_cache_size = 64
+        self.web_search_page_size = 25
+
+        self.rss_feeds_fetch_workers = 8
+        self.rss_feeds_fetch_timeout = 30
+
+        self.minhash_permutations = 64
+        self.minhash_rows_per_band = 4
+        self.minhash_shingle_size = 5
+        self.minhash_similarity_threshold = 0.7
+        self.minhash_backfill_limit = 5000
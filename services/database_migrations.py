@@ -0,0 +1,322 @@
+import logging
+
+from sqlite3 import Connection, Cursor
+
+
+# region Helper Methods
+
+def _add_column_if_not_exists(cursor: Cursor, table: str, column: str, definition: str):
+    # Databases created before the schema was versioned may already have the column
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+# endregion
+
+# region Migrations
+
+def _create_initial_schema(cursor: Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS areas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            title TEXT NOT NULL,
+            instructions_filename TEXT NOT NULL,
+            model TEXT NOT NULL,
+            needs_code_interpreter INTEGER NOT NULL,
+            needs_retrieval INTEGER NOT NULL,
+            ai_id TEXT,
+            ai_created TEXT,
+            ai_last_update TEXT,
+            checksum TEXT,
+            priority INTEGER NOT NULL,
+            enabled INTEGER NOT NULL
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS rss_feeds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            link TEXT NOT NULL UNIQUE,
+            web_link TEXT,
+            title TEXT,
+            last_update TEXT,
+            last_error TEXT
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS areas_x_rss_feeds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            area_id INTEGER NOT NULL,
+            rss_feed_id INTEGER NOT NULL,
+            priority INTEGER NOT NULL,
+            enabled INTEGER NOT NULL
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            link TEXT NOT NULL UNIQUE,
+            title TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            published TEXT NOT NULL,
+            created TEXT NOT NULL,
+            rss_feed_id INTEGER,
+            ai_fileid TEXT,
+            saved INTEGER
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS topics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            area_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            created TEXT,
+            my_rating INTEGER,
+            ai_rating INTEGER,
+            ai_analysis TEXT,
+            read INTEGER,
+            saved INTEGER
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS posts_x_topics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            topic_id INTEGER NOT NULL
+        );
+    """)
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS posts_x_topics_unique 
+        ON posts_x_topics(post_id, topic_id);
+    """)
+
+
+def _add_rss_feed_validators(cursor: Cursor):
+    _add_column_if_not_exists(cursor, "rss_feeds", "etag", "TEXT")
+    _add_column_if_not_exists(cursor, "rss_feeds", "modified", "TEXT")
+    _add_column_if_not_exists(cursor, "rss_feeds", "content_hash", "TEXT")
+
+
+def _add_area_completion_settings(cursor: Cursor):
+    _add_column_if_not_exists(cursor, "areas", "completion_mode", "TEXT NOT NULL DEFAULT 'poll'")
+    _add_column_if_not_exists(cursor, "areas", "batch_token_budget", "INTEGER")
+
+
+def _create_ai_responses(cursor: Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ai_responses (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created TEXT NOT NULL,
+            size INTEGER NOT NULL
+        );
+    """)
+
+
+def _create_pending_posts(cursor: Cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS posts_rss_feed_id ON posts(rss_feed_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS posts_x_topics_topic_id ON posts_x_topics(topic_id);")
+
+    # Work queue of posts which still need a topic in an area, filled on insert and cleared on assignment
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pending_posts (
+            area_id INTEGER NOT NULL,
+            post_id INTEGER NOT NULL,
+            PRIMARY KEY (area_id, post_id)
+        ) WITHOUT ROWID;
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO pending_posts(area_id, post_id)
+        SELECT areas_x_rss_feeds.area_id, posts.id
+        FROM posts
+        JOIN areas_x_rss_feeds ON areas_x_rss_feeds.rss_feed_id = posts.rss_feed_id
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM posts_x_topics
+            JOIN topics ON topics.id = posts_x_topics.topic_id
+            WHERE
+                posts_x_topics.post_id = posts.id
+                AND topics.area_id = areas_x_rss_feeds.area_id
+        )
+    """)
+
+
+def _create_area_stats(cursor: Cursor):
+    cursor.execute("DROP INDEX IF EXISTS topics_area_id;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS topics_area_id_read ON topics(area_id, read);")
+
+    # Unread counters for the navigation, kept up to date by add_topic and toggle_topic_read
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS area_stats (
+            area_id INTEGER PRIMARY KEY,
+            number_of_unread_topics INTEGER NOT NULL
+        );
+    """)
+    cursor.execute("""
+        INSERT OR REPLACE INTO area_stats(area_id, number_of_unread_topics)
+        SELECT area_id, SUM(CASE WHEN read = 0 THEN 1 ELSE 0 END)
+        FROM topics
+        GROUP BY area_id
+    """)
+
+
+def _add_topic_view_indexes(cursor: Cursor):
+    # Match the filter and the keyset order of get_topics_for_view, with and without an area
+    cursor.execute("DROP INDEX IF EXISTS topics_area_id_read;")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS topics_area_id_read_view
+        ON topics(area_id, read, ai_rating, created DESC, id DESC);
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS topics_read_view
+        ON topics(read, ai_rating, created DESC, id DESC);
+    """)
+
+
+def _create_data_version(cursor: Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS data_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            updated TEXT NOT NULL
+        );
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO data_version(id, version, updated)
+        VALUES(1, 1, strftime('%Y-%m-%dT%H:%M:%S', 'now'))
+    """)
+
+
+def _create_full_text_search(cursor: Cursor):
+    # External content tables: the text is only stored once, in posts and topics, and triggers keep the index in sync
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts
+        USING fts5(title, summary, content='posts', content_rowid='id');
+    """)
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS topics_fts
+        USING fts5(title, summary, ai_analysis, content='topics', content_rowid='id');
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts(rowid, title, summary) VALUES (new.id, new.title, new.summary);
+        END;
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+            INSERT INTO posts_fts(posts_fts, rowid, title, summary) VALUES ('delete', old.id, old.title, old.summary);
+        END;
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF title, summary ON posts BEGIN
+            INSERT INTO posts_fts(posts_fts, rowid, title, summary) VALUES ('delete', old.id, old.title, old.summary);
+            INSERT INTO posts_fts(rowid, title, summary) VALUES (new.id, new.title, new.summary);
+        END;
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS topics_fts_insert AFTER INSERT ON topics BEGIN
+            INSERT INTO topics_fts(rowid, title, summary, ai_analysis)
+            VALUES (new.id, new.title, new.summary, new.ai_analysis);
+        END;
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS topics_fts_delete AFTER DELETE ON topics BEGIN
+            INSERT INTO topics_fts(topics_fts, rowid, title, summary, ai_analysis)
+            VALUES ('delete', old.id, old.title, old.summary, old.ai_analysis);
+        END;
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS topics_fts_update AFTER UPDATE OF title, summary, ai_analysis ON topics BEGIN
+            INSERT INTO topics_fts(topics_fts, rowid, title, summary, ai_analysis)
+            VALUES ('delete', old.id, old.title, old.summary, old.ai_analysis);
+            INSERT INTO topics_fts(rowid, title, summary, ai_analysis)
+            VALUES (new.id, new.title, new.summary, new.ai_analysis);
+        END;
+    """)
+    cursor.execute("INSERT INTO posts_fts(posts_fts) VALUES ('rebuild');")
+    cursor.execute("INSERT INTO topics_fts(topics_fts) VALUES ('rebuild');")
+
+
+def _create_post_signatures(cursor: Cursor):
+    _add_column_if_not_exists(cursor, "posts", "duplicate_of", "INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS posts_duplicate_of ON posts(duplicate_of);")
+
+    # MinHash signatures of the posts, and their LSH band buckets to find candidate duplicates by index
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS post_signatures (
+            post_id INTEGER PRIMARY KEY,
+            signature BLOB NOT NULL
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS post_buckets (
+            band INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            post_id INTEGER NOT NULL,
+            PRIMARY KEY (band, bucket, post_id)
+        ) WITHOUT ROWID;
+    """)
+
+
+def _create_archived_post_links(cursor: Cursor):
+    # Links of posts moved to the archive database, kept to recognize them when a feed still lists them
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS archived_post_links (
+            link TEXT PRIMARY KEY
+        ) WITHOUT ROWID;
+    """)
+
+
+def _reset_post_signatures(cursor: Cursor):
+    # The MinHash permutations changed, signatures of both versions cannot be compared.
+    # Posts without a signature get a new one with the next backfill.
+    cursor.execute("DELETE FROM post_buckets;")
+    cursor.execute("DELETE FROM post_signatures;")
+
+
+# endregion
+
+# Append only: the position of a migration is the schema version it upgrades to.
+# Databases created before versioning are at version 0, so the first migrations must tolerate existing objects.
+_MIGRATIONS = [
+    _create_initial_schema,
+    _add_rss_feed_validators,
+    _add_area_completion_settings,
+    _create_ai_responses,
+    _create_pending_posts,
+    _create_area_stats,
+    _add_topic_view_indexes,
+    _create_data_version,
+    _create_full_text_search,
+    _create_post_signatures,
+    _create_archived_post_links,
+    _reset_post_signatures,
+]
+
+
+def _get_user_version(cursor: Cursor) -> int:
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+
+def migrate(connection: Connection):
+    cursor = connection.cursor()
+    if _get_user_version(cursor) >= len(_MIGRATIONS):
+        return
+
+    # BEGIN IMMEDIATE takes the write lock first, so two processes starting together migrate only once
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        version = _get_user_version(cursor)
+        while version < len(_MIGRATIONS):
+            migration = _MIGRATIONS[version]
+            logging.info(f"Migrating database to version {version + 1} ({migration.__name__})")
+            migration(cursor)
+            version += 1
+            cursor.execute(f"PRAGMA user_version = {version}")
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
@@ -0,0 +1,31 @@
+import threading
+
+from services.config_service import ConfigService
+from services.database_service import DatabaseService
+
+
+class DatabasePoolService:
+    def __init__(self, config_service: ConfigService):
+        self.config_service = config_service
+        self.lock = threading.Lock()
+        self.idle_database_services = []
+
+    def acquire(self) -> DatabaseService:
+        with self.lock:
+            if len(self.idle_database_services) > 0:
+                return self.idle_database_services.pop()
+        return DatabaseService(self.config_service)
+
+    def release(self, database_service: DatabaseService):
+        database_service.reset()
+        with self.lock:
+            if len(self.idle_database_services) < self.config_service.database_pool_size:
+                self.idle_database_services.append(database_service)
+                return
+        database_service.close()
+
+    def close_all(self):
+        with self.lock:
+            for database_service in self.idle_database_services:
+                database_service.close()
+            self.idle_database_services = []
@@ -1,14 +1,24 @@
 import sqlite3
+import threading
 
-from datetime import datetime
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
 from sqlite3 import Cursor
+from typing import Any, Callable, Iterator
 
 from model.area import Area
 from model.area_web import AreaWeb
 from model.post import Post
 from model.topic import Topic
 from model.rss_feed import RssFeed
+from model.search_result import SearchResult
 from services.config_service import ConfigService
+from services.database_migrations import migrate
+from services.metrics_service import timed_methods
+
+
+SEARCH_MATCH_START = "\x02"
+SEARCH_MATCH_END = "\x03"
 
 
 # region Helper Methods
@@ -24,7 +34,12 @@ def _text_to_datetime(text_value: str) -> datetime | None:
     if text_value is None:
         return None
     else:
-        return datetime.strptime(text_value, '%Y-%m-%dT%H:%M:%S')
+        return datetime.fromisoformat(text_value)
+
+
+def _text_to_fts_query(text: str) -> str:
+    # Every word becomes a quoted term, so user input can never be a broken FTS5 expression
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
 
 
 def _bool_to_int(bool_value: bool) -> int | None:
@@ -41,96 +56,102 @@ def _int_to_bool(int_value: int) -> bool | None:
         return int_value != 0
 
 
+# region Row Factories
+# Rows are mapped straight to the models, dates are handed over as text and only decoded when they are used
+
+def _row_to_area(cursor: Cursor, row: tuple) -> Area:
+    return Area(area_id=row[0], name=row[1], title=row[2], instructions_filename=row[3], model=row[4],
+                needs_code_interpreter=_int_to_bool(row[5]), needs_retrieval=_int_to_bool(row[6]), ai_id=row[7],
+                ai_created=row[8], ai_last_update=row[9], checksum=row[10], priority=row[11],
+                enabled=_int_to_bool(row[12]), completion_mode=row[13], batch_token_budget=row[14])
+
+
+def _row_to_area_web(cursor: Cursor, row: tuple) -> AreaWeb:
+    return AreaWeb(area_id=row[0], title=row[1], number_of_unread_topics=row[2])
+
+
+def _row_to_post(cursor: Cursor, row: tuple) -> Post:
+    return Post(post_id=row[0], link=row[1], title=row[2], summary=row[3], published=row[4], created=row[5],
+                rss_feed_id=row[6], ai_fileid=row[7], saved=_int_to_bool(row[8]))
+
+
+def _row_to_topic(cursor: Cursor, row: tuple) -> Topic:
+    return Topic(topic_id=row[0], area_id=row[1], title=row[2], summary=row[3], created=row[4], my_rating=row[5],
+                 ai_rating=row[6], ai_analysis=row[7], read=_int_to_bool(row[8]), saved=_int_to_bool(row[9]))
+
+
+def _row_to_rss_feed(cursor: Cursor, row: tuple) -> RssFeed:
+    return RssFeed(rss_feed_id=row[0], link=row[1], web_link=row[2], title=row[3], last_update=row[4],
+                   last_error=row[5], etag=row[6], modified=row[7], content_hash=row[8])
+
+
+def _row_to_search_result(cursor: Cursor, row: tuple) -> SearchResult:
+    return SearchResult(kind=row[0], item_id=row[1], title=row[2], snippet=row[3], rank=row[4], link=row[5],
+                        created=row[6])
+
+
 # endregion
 
+# Generators only do their work while they are consumed, so they are timed through their list variants
+@timed_methods("mentalist_database_seconds", exclude=("close", "reset", "transaction",
+                                                     "iter_posts_by_area_without_topic", "iter_topics_for_view"))
 class DatabaseService:
+    _migrated_databases = set()
+    _migrated_databases_lock = threading.Lock()
 
     # region _Private Methods
 
     def __init__(self, config_service: ConfigService):
-        self.connection = sqlite3.connect(config_service.database_filename)
+        # Connections may be handed between threads by DatabasePoolService, but are only used by one at a time
+        self.connection = sqlite3.connect(config_service.database_filename, check_same_thread=False)
         self.cursor = self.connection.cursor()
-        self._create_db()
-
-    def __del__(self):
+        self._in_transaction = False
+        self._rss_feeds_by_id = None
+        self._archive_filename = config_service.database_archive_filename
+        self._archive_attached = False
+
+        # Only takes effect for new databases, existing ones are switched by the first compact()
+        self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL lets the web UI read while the ingestion writes
+        self.cursor.execute("PRAGMA journal_mode = WAL")
+        self.cursor.execute("PRAGMA synchronous = NORMAL")
+        self.cursor.execute(f"PRAGMA busy_timeout = {config_service.database_busy_timeout}")
+        self.cursor.execute(f"PRAGMA cache_size = -{config_service.database_cache_size}")
+        self.cursor.execute("PRAGMA temp_store = MEMORY")
+
+        # After the first connection in a process the schema is known to be current, so even the version check is skipped
+        with DatabaseService._migrated_databases_lock:
+            if config_service.database_filename not in DatabaseService._migrated_databases:
+                migrate(self.connection)
+                DatabaseService._migrated_databases.add(config_service.database_filename)
+
+    def _attach_archive(self):
+        # The archive has the same schema as the main database, it is only attached where it is needed
+        if self._archive_attached:
+            return
+        with DatabaseService._migrated_databases_lock:
+            if self._archive_filename not in DatabaseService._migrated_databases:
+                with closing(sqlite3.connect(self._archive_filename)) as archive_connection:
+                    migrate(archive_connection)
+                DatabaseService._migrated_databases.add(self._archive_filename)
+        self.cursor.execute("ATTACH DATABASE ? AS archive", (self._archive_filename,))
+        self._archive_attached = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
         self.connection.close()
 
-    def _create_db(self):
-        self._execute_sql("""
-            CREATE TABLE IF NOT EXISTS areas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE,
-                title TEXT NOT NULL,
-                instructions_filename TEXT NOT NULL,
-                model TEXT NOT NULL,
-                needs_code_interpreter INTEGER NOT NULL,
-                needs_retrieval INTEGER NOT NULL,
-                ai_id TEXT,
-                ai_created TEXT,
-                ai_last_update TEXT,
-                checksum TEXT,
-                priority INTEGER NOT NULL,
-                enabled INTEGER NOT NULL
-            );
-        """)
-        self._execute_sql("""
-            CREATE TABLE IF NOT EXISTS rss_feeds (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                link TEXT NOT NULL UNIQUE,
-                web_link TEXT,
-                title TEXT,
-                last_update TEXT,
-                last_error TEXT
-            );
-        """)
-        self._execute_sql("""
-            CREATE TABLE IF NOT EXISTS areas_x_rss_feeds (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                area_id INTEGER NOT NULL,
-                rss_feed_id INTEGER NOT NULL,
-                priority INTEGER NOT NULL,
-                enabled INTEGER NOT NULL
-            );
-        """)
-
-        self._execute_sql("""
-            CREATE TABLE IF NOT EXISTS posts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                link TEXT NOT NULL UNIQUE,
-                title TEXT NOT NULL,
-                summary TEXT NOT NULL,
-                published TEXT NOT NULL,
-                created TEXT NOT NULL,
-                rss_feed_id INTEGER,
-                ai_fileid TEXT,
-                saved INTEGER
-            );
-        """)
-        self._execute_sql("""
-            CREATE TABLE IF NOT EXISTS topics (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                area_id INTEGER NOT NULL,
-                title TEXT NOT NULL,
-                summary TEXT NOT NULL,
-                created TEXT,
-                my_rating INTEGER,
-                ai_rating INTEGER,
-                ai_analysis TEXT,
-                read INTEGER,
-                saved INTEGER
-            );
-        """)
-        self._execute_sql("""
-            CREATE TABLE IF NOT EXISTS posts_x_topics (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_id INTEGER NOT NULL,
-                topic_id INTEGER NOT NULL
-            );
-        """)
-        self._execute_sql("""
-            CREATE UNIQUE INDEX IF NOT EXISTS posts_x_topics_unique 
-            ON posts_x_topics(post_id, topic_id);
-        """)
+    def reset(self):
+        # Prepares a pooled connection for its next user
+        if self.connection.in_transaction:
+            self.connection.rollback()
+        self._in_transaction = False
+        self._rss_feeds_by_id = None
 
     def _execute_sql(self, sql, data=None) -> Cursor:
         cursor = None
@@ -139,18 +160,67 @@ class DatabaseService:
                 cursor = self.cursor.execute(sql)
             else:
                 cursor = self.cursor.execute(sql, data)
-            self.connection.commit()
+            if not self._in_transaction:
+                self.connection.commit()
         except sqlite3.Error as e:
             print(f"Database error: {e}\nSQL:{sql}")
+            if self._in_transaction:
+                raise
             self.connection.rollback()
         except Exception as e:
             print(f"Exception in _query: {e}\nSQL:{sql}")
+            if self._in_transaction:
+                raise
             self.connection.rollback()
         return cursor
 
+    def _execute_many_sql(self, sql, data: list) -> Cursor:
+        cursor = None
+        try:
+            cursor = self.cursor.executemany(sql, data)
+            if not self._in_transaction:
+                self.connection.commit()
+        except sqlite3.Error as e:
+            print(f"Database error: {e}\nSQL:{sql}")
+            if self._in_transaction:
+                raise
+            self.connection.rollback()
+        return cursor
+
+    def _iter_rows(self, sql: str, row_factory: Callable[[Cursor, tuple], Any], data=()) -> Iterator[Any]:
+        # A cursor of its own, so the caller may run other queries while it consumes the rows
+        cursor = self.connection.cursor()
+        cursor.row_factory = row_factory
+        cursor.execute(sql, data)
+        yield from cursor
+
     # endregion
 
+    @contextmanager
+    def transaction(self):
+        if self._in_transaction:
+            yield
+            return
+
+        self._in_transaction = True
+        try:
+            yield
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            self._in_transaction = False
+
     def import_areas(self, areas: list[Area]):
+        with self.transaction():
+            # The navigation of every page shows the enabled areas, a change has to invalidate the cached pages
+            areas_for_web = [(area_web.id, area_web.title) for area_web in self.get_areas_for_web()]
+            self._import_areas(areas)
+            if [(area_web.id, area_web.title) for area_web in self.get_areas_for_web()] != areas_for_web:
+                self._bump_data_version()
+
+    def _import_areas(self, areas: list[Area]):
         self.disable_all_areas()
         self.disable_all_rss_feeds()
 
@@ -166,6 +236,8 @@ class DatabaseService:
                 existing_area.model = area.model
                 existing_area.priority = area.priority
                 existing_area.enabled = area.enabled
+                existing_area.completion_mode = area.completion_mode
+                existing_area.batch_token_budget = area.batch_token_budget
                 self.update_area(existing_area)
                 area_id = existing_area.id
 
@@ -188,13 +260,14 @@ class DatabaseService:
         sql = """
             INSERT INTO areas
                 (name, title, instructions_filename, model, needs_code_interpreter, needs_retrieval, 
-                ai_id, ai_created, ai_last_update, checksum, priority, enabled)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ai_id, ai_created, ai_last_update, checksum, priority, enabled, completion_mode, batch_token_budget)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """
         data = (area.name, area.title, area.instructions_filename, area.model,
                 _bool_to_int(area.needs_code_interpreter), _bool_to_int(area.needs_retrieval),
                 area.ai_id, _datetime_to_text(area.ai_created), _datetime_to_text(area.ai_last_update),
-                area.checksum, area.priority, _bool_to_int(area.enabled))
+                area.checksum, area.priority, _bool_to_int(area.enabled), area.completion_mode,
+                area.batch_token_budget)
         cursor = self._execute_sql(sql, data)
         area.id = cursor.lastrowid
 
@@ -210,47 +283,46 @@ class DatabaseService:
     def get_areas_for_web(self) -> list[AreaWeb]:
         areas_for_web = [AreaWeb(area_id=0, title="All",
                                  number_of_unread_topics=0)]
-        areas = self.get_enabled_areas()
-        for area in areas:
-            number_of_unread_topics = self.get_number_of_unread_topics(area.id)
-            areas_for_web.append(AreaWeb(area_id=area.id, title=area.title,
-                                         number_of_unread_topics=number_of_unread_topics))
-            areas_for_web[0].number_of_unread_topics += number_of_unread_topics
+        for area_web in self._iter_rows(f"""
+            SELECT areas.id, areas.title, IFNULL(area_stats.number_of_unread_topics, 0)
+            FROM areas
+            LEFT JOIN area_stats ON area_stats.area_id = areas.id
+            WHERE areas.enabled = {_bool_to_int(True)}
+            ORDER BY areas.priority, areas.id
+        """, _row_to_area_web):
+            areas_for_web.append(area_web)
+            areas_for_web[0].number_of_unread_topics += area_web.number_of_unread_topics
 
         return areas_for_web
 
     def _get_areas(self, where: str, order_by: str = "priority, id") -> list[Area]:
+        return list(self._iter_areas(where, order_by))
+
+    def _iter_areas(self, where: str, order_by: str = "priority, id") -> Iterator[Area]:
         sql = f"""
             SELECT
                 id, name, title, instructions_filename, model, needs_code_interpreter, needs_retrieval, 
-                ai_id, ai_created, ai_last_update, checksum, priority, enabled
+                ai_id, ai_created, ai_last_update, checksum, priority, enabled, completion_mode,
+                batch_token_budget
             FROM areas
             WHERE {where}
             ORDER BY {order_by}
         """
-        self.cursor.execute(sql)
-        rows = self.cursor.fetchall()
-
-        areas = []
-        for row in rows:
-            areas.append(Area(area_id=row[0], name=row[1], title=row[2], instructions_filename=row[3],
-                              model=row[4], needs_code_interpreter=_int_to_bool(row[5]),
-                              needs_retrieval=_int_to_bool(row[6]), ai_id=row[7],
-                              ai_created=_text_to_datetime(row[8]), ai_last_update=_text_to_datetime(row[9]),
-                              checksum=row[10], priority=row[11], enabled=_int_to_bool(row[12])))
-        return areas
+        return self._iter_rows(sql, _row_to_area)
 
     def update_area(self, area: Area):
         sql = """
             UPDATE areas SET 
                 name=?, title=?, instructions_filename=?, model=?, needs_code_interpreter=?, needs_retrieval=?, 
-                ai_id=?, ai_created=?, ai_last_update=?, checksum=?, priority=?, enabled=?
+                ai_id=?, ai_created=?, ai_last_update=?, checksum=?, priority=?, enabled=?, completion_mode=?,
+                batch_token_budget=?
             WHERE id=?
         """
         data = (area.name, area.title, area.instructions_filename, area.model,
                 _bool_to_int(area.needs_code_interpreter), _bool_to_int(area.needs_retrieval),
                 area.ai_id, _datetime_to_text(area.ai_created), _datetime_to_text(area.ai_last_update),
-                area.checksum, area.priority, _bool_to_int(area.enabled), area.id)
+                area.checksum, area.priority, _bool_to_int(area.enabled), area.completion_mode,
+                area.batch_token_budget, area.id)
         self._execute_sql(sql, data)
 
     def disable_all_areas(self):
@@ -270,8 +342,45 @@ class DatabaseService:
         """
         data = (post.link, post.title, post.summary, _datetime_to_text(post.published),
                 _datetime_to_text(post.created), post.rss_feed_id, post.ai_fileid, _bool_to_int(post.saved))
-        cursor = self._execute_sql(sql, data)
-        post.id = cursor.lastrowid
+        with self.transaction():
+            cursor = self._execute_sql(sql, data)
+            post.id = cursor.lastrowid
+            if cursor.rowcount > 0:
+                self._add_pending_posts(f"posts.id = {post.id}")
+
+    def add_posts(self, posts: list[Post]) -> list[Post]:
+        # Returns only the posts which were not stored yet
+        if len(posts) < 1:
+            return []
+
+        sql = """
+            INSERT OR IGNORE INTO posts
+                (link, title, summary, published, created, rss_feed_id, ai_fileid, saved)
+            VALUES
+                (?, ?, ?, ?, ?, ?, ?, ?)
+        """
+        data = [(post.link, post.title, post.summary, _datetime_to_text(post.published),
+                 _datetime_to_text(post.created), post.rss_feed_id, post.ai_fileid, _bool_to_int(post.saved))
+                for post in posts]
+
+        with self.transaction():
+            # AUTOINCREMENT ids only grow, so everything above the current maximum was inserted by this batch
+            self.cursor.execute("SELECT IFNULL(MAX(id), 0) FROM posts")
+            last_post_id = self.cursor.fetchone()[0]
+            self._execute_many_sql(sql, data)
+            self.cursor.execute("SELECT id, link FROM posts WHERE id > ?", (last_post_id,))
+            new_post_ids = {row[1]: row[0] for row in self.cursor.fetchall()}
+            self._add_pending_posts(f"posts.id > {last_post_id}")
+            if len(new_post_ids) > 0:
+                self._bump_data_version()
+
+        new_posts = []
+        for post in posts:
+            post_id = new_post_ids.pop(post.link, None)
+            if post_id is not None:
+                post.id = post_id
+                new_posts.append(post)
+        return new_posts
 
     def update_post(self, post: Post):
         sql = """
@@ -284,40 +393,64 @@ class DatabaseService:
                 _datetime_to_text(post.created), post.rss_feed_id, post.ai_fileid, _bool_to_int(post.saved), post.id)
         self._execute_sql(sql, data)
 
-    def get_posts_by_area_without_topic(self, area_id: int) -> list[Post]:
-        return self._get_posts(f"""
-            posts.rss_feed_id IN (
-                SELECT areas_x_rss_feeds.rss_feed_id 
-                FROM areas_x_rss_feeds
-                WHERE areas_x_rss_feeds.area_id = {area_id}
-            ) 
-            AND
-            (
-                SELECT COUNT(*) 
-                FROM posts_x_topics 
-                JOIN topics ON topics.id = posts_x_topics.topic_id
-                WHERE 
-                    posts_x_topics.post_id = posts.id
-                    AND topics.area_id = {area_id}
-            ) = 0
+    def get_known_post_links(self, links: list[str]) -> set[str]:
+        # Only looks up the given links, chunked to stay below the SQLite limit of bound parameters
+        known_links = set()
+        for start in range(0, len(links), 500):
+            chunk = links[start:start + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            self.cursor.execute(f"""
+                SELECT link FROM posts WHERE link IN ({placeholders})
+                UNION ALL
+                SELECT link FROM archived_post_links WHERE link IN ({placeholders})
+            """, chunk + chunk)
+            known_links.update(row[0] for row in self.cursor)
+        return known_links
+
+    def get_posts_by_area_without_topic(self, area_id: int, after_post_id: int = 0, limit: int = -1) -> list[Post]:
+        return list(self.iter_posts_by_area_without_topic(area_id, after_post_id, limit))
+
+    def iter_posts_by_area_without_topic(self, area_id: int, after_post_id: int = 0,
+                                         limit: int = -1) -> Iterator[Post]:
+        return self._iter_posts(f"""
+            posts.id IN (
+                SELECT pending_posts.post_id
+                FROM pending_posts
+                WHERE pending_posts.area_id = {area_id} AND pending_posts.post_id > {after_post_id}
+                ORDER BY pending_posts.post_id
+                LIMIT {limit}
+            )
+        """)
+
+    def get_pending_posts_stats(self) -> dict[int, tuple[int, datetime]]:
+        self.cursor.execute("""
+            SELECT pending_posts.area_id, COUNT(*), MIN(posts.created)
+            FROM pending_posts
+            JOIN posts ON posts.id = pending_posts.post_id
+            GROUP BY pending_posts.area_id
+        """)
+        return {row[0]: (row[1], _text_to_datetime(row[2])) for row in self.cursor.fetchall()}
+
+    def _add_pending_posts(self, posts_where: str):
+        self._execute_sql(f"""
+            INSERT OR IGNORE INTO pending_posts(area_id, post_id)
+            SELECT areas_x_rss_feeds.area_id, posts.id
+            FROM posts
+            JOIN areas_x_rss_feeds ON areas_x_rss_feeds.rss_feed_id = posts.rss_feed_id
+            WHERE {posts_where}
         """)
 
     def _get_posts(self, where: str, order_by: str = "id") -> list[Post]:
-        self.cursor.execute(f"""
+        return list(self._iter_posts(where, order_by))
+
+    def _iter_posts(self, where: str, order_by: str = "id") -> Iterator[Post]:
+        return self._iter_rows(f"""
             SELECT 
                 id, link, title, summary, published, created, rss_feed_id, ai_fileid, saved
             FROM posts
             WHERE {where}
             ORDER BY {order_by}
-        """)
-        rows = self.cursor.fetchall()
-        posts = []
-        for row in rows:
-            post = Post(post_id=row[0], link=row[1], title=row[2], summary=row[3],
-                        published=_text_to_datetime(row[4]), created=_text_to_datetime(row[5]),
-                        rss_feed_id=row[6], ai_fileid=row[7], saved=_int_to_bool(row[8]))
-            posts.append(post)
-        return posts
+        """, _row_to_post)
 
     # endregion
 
@@ -332,62 +465,153 @@ class DatabaseService:
         data = (topic.area_id, topic.title, topic.summary, _datetime_to_text(topic.created),
                 topic.my_rating, topic.ai_rating, topic.ai_analysis,
                 _bool_to_int(topic.read), _bool_to_int(topic.saved))
-        cursor = self._execute_sql(sql, data)
-        topic.id = cursor.lastrowid
+        with self.transaction():
+            cursor = self._execute_sql(sql, data)
+            topic.id = cursor.lastrowid
+            if not topic.read:
+                self._execute_sql("""
+                    INSERT INTO area_stats(area_id, number_of_unread_topics) VALUES(?, 1)
+                    ON CONFLICT(area_id) DO UPDATE SET number_of_unread_topics = number_of_unread_topics + 1
+                """, (topic.area_id,))
+            self._bump_data_version()
 
     def get_topic_by_id(self, topic_id: int) -> Topic | None:
-        topics = self._get_topics(f"id={topic_id}", "id")
+        topics = self._get_topics("id = ?", "id", data=(topic_id,))
         if len(topics) > 0:
             return topics[0]
         return None
 
-    def get_topics_for_view(self, area_id: int) -> list[Topic]:
-        topics = self._get_topics(where=f"read = {_bool_to_int(False)} AND {area_id} IN (area_id, 0)",
-                                  order_by="ai_rating, created DESC")
-        for topic in topics:
-            topic.posts = self._get_posts(f"""
-                posts.id IN (
-                    SELECT posts_x_topics.post_id 
-                    FROM posts_x_topics 
-                    WHERE posts_x_topics.topic_id = {topic.id}
-                )
-            """, "rss_feed_id, published ASC")
-            for post in topic.posts:
-                post.rss_feed = self.get_rss_feed_by_id(post.rss_feed_id)
+    def get_topics_for_view(self, area_id: int, after_topic_id: int = None, limit: int = -1) -> list[Topic]:
+        return list(self.iter_topics_for_view(area_id, after_topic_id, limit))
+
+    def iter_topics_for_view(self, area_id: int, after_topic_id: int = None, limit: int = -1) -> Iterator[Topic]:
+        where = f"read = {_bool_to_int(False)}"
+        data = ()
+        if area_id != 0:
+            where += " AND area_id = ?"
+            data = (area_id,)
+
+        # Keyset pagination: continues right after the given topic in the (ai_rating, created DESC, id DESC) order
+        after_topic = None if after_topic_id is None else self.get_topic_by_id(after_topic_id)
+        if after_topic is not None:
+            where += """
+                AND (ai_rating > ? OR (ai_rating = ? AND (created < ? OR (created = ? AND id < ?))))
+            """
+            after_created = _datetime_to_text(after_topic.created)
+            data += (after_topic.ai_rating, after_topic.ai_rating, after_created, after_created, after_topic.id)
+
+        return self._iter_topics(where=where, order_by="ai_rating, created DESC, id DESC", limit=limit, data=data)
+
+    def get_recent_topics(self, area_id: int, created_after: datetime) -> list[Topic]:
+        topics = self._get_topics(where=f"area_id = {area_id} AND created >= ?", order_by="created DESC, id DESC",
+                                  data=(_datetime_to_text(created_after),))
+        self._add_posts_to_topics(topics)
         return topics
 
-    def toggle_topic_saved(self, topic_id):
-        sql = f"UPDATE topics SET saved = (1 - saved) WHERE id = {topic_id}"
-        self._execute_sql(sql)
+    def get_posts_for_topic(self, topic_id: int) -> list[Post]:
+        topic = self.get_topic_by_id(topic_id)
+        if topic is None:
+            return []
+        self._add_posts_to_topics([topic])
+        return topic.posts
+
+    def _add_posts_to_topics(self, topics: list[Topic]):
+        if len(topics) < 1:
+            return
+
+        # Loads the posts of all topics at once instead of one query per topic and per post
+        topic_ids = ", ".join(str(topic.id) for topic in topics)
+        posts = self._iter_posts(f"""
+            posts.id IN (
+                SELECT posts_x_topics.post_id 
+                FROM posts_x_topics 
+                WHERE posts_x_topics.topic_id IN ({topic_ids})
+            )
+        """, "rss_feed_id, published ASC")
 
-    def toggle_topic_read(self, topic_id):
-        sql = f"UPDATE topics SET read = (1 - read) WHERE id = {topic_id}"
-        self._execute_sql(sql)
+        self.cursor.execute(f"""
+            SELECT post_id, topic_id
+            FROM posts_x_topics
+            WHERE topic_id IN ({topic_ids})
+        """)
+        topic_ids_by_post_id = {}
+        for row in self.cursor.fetchall():
+            topic_ids_by_post_id.setdefault(row[0], []).append(row[1])
+
+        topics_by_id = {topic.id: topic for topic in topics}
+        rss_feeds_by_id = self._get_rss_feeds_by_id()
+        for post in posts:
+            post.rss_feed = rss_feeds_by_id.get(post.rss_feed_id)
+            for topic_id in topic_ids_by_post_id[post.id]:
+                topics_by_id[topic_id].posts.append(post)
+
+    def toggle_topic_saved(self, topic_id) -> bool | None:
+        sql = "UPDATE topics SET saved = (1 - saved) WHERE id = ?"
+        with self.transaction():
+            self._execute_sql(sql, (topic_id,))
+            self._bump_data_version()
+        return self._get_topic_flag(topic_id, "saved")
+
+    def toggle_topic_read(self, topic_id) -> bool | None:
+        sql = "UPDATE topics SET read = (1 - read) WHERE id = ?"
+        with self.transaction():
+            self._execute_sql(sql, (topic_id,))
+            self._execute_sql("""
+                UPDATE area_stats
+                SET number_of_unread_topics = number_of_unread_topics + 
+                    (SELECT CASE WHEN topics.read = 0 THEN 1 ELSE -1 END FROM topics WHERE topics.id = ?)
+                WHERE area_id = (SELECT topics.area_id FROM topics WHERE topics.id = ?)
+            """, (topic_id, topic_id))
+            self._bump_data_version()
+        return self._get_topic_flag(topic_id, "read")
+
+    def set_topics_read(self, topic_ids: list[int], read: bool = True):
+        if len(topic_ids) < 1:
+            return
+
+        topic_ids_sql = ", ".join(str(int(topic_id)) for topic_id in topic_ids)
+        with self.transaction():
+            self._execute_sql(f"UPDATE topics SET read = {_bool_to_int(read)} WHERE id IN ({topic_ids_sql})")
+            self._recalculate_area_stats(f"area_id IN (SELECT area_id FROM topics WHERE id IN ({topic_ids_sql}))")
+            self._bump_data_version()
+
+    def _get_topic_flag(self, topic_id: int, column: str) -> bool | None:
+        self.cursor.execute(f"SELECT {column} FROM topics WHERE id = ?", (topic_id,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return _int_to_bool(row[0])
+
+    def _recalculate_area_stats(self, topics_where: str):
+        self._execute_sql(f"""
+            INSERT OR REPLACE INTO area_stats(area_id, number_of_unread_topics)
+            SELECT area_id, SUM(CASE WHEN read = 0 THEN 1 ELSE 0 END)
+            FROM topics
+            WHERE {topics_where}
+            GROUP BY area_id
+        """)
 
     def get_number_of_unread_topics(self, area_id: int) -> int:
-        sql = f"""
-            SELECT COUNT(*) FROM topics WHERE area_id = {area_id} AND read = {_bool_to_int(False)}
-        """
+        sql = f"SELECT number_of_unread_topics FROM area_stats WHERE area_id = {area_id}"
         self.cursor.execute(sql)
-        return self.cursor.fetchone()[0]
+        row = self.cursor.fetchone()
+        if row is None:
+            return 0
+        return row[0]
 
-    def _get_topics(self, where: str, order_by) -> list[Topic]:
+    def _get_topics(self, where: str, order_by, limit: int = -1, data=()) -> list[Topic]:
+        return list(self._iter_topics(where, order_by, limit, data))
+
+    def _iter_topics(self, where: str, order_by, limit: int = -1, data=()) -> Iterator[Topic]:
         sql = f"""
             SELECT
                 id, area_id, title, summary, created, my_rating, ai_rating, ai_analysis, read, saved
             FROM topics
             WHERE {where}
             ORDER BY {order_by}
+            LIMIT {limit}
             """
-        self.cursor.execute(sql)
-        rows = self.cursor.fetchall()
-        topics = []
-        for row in rows:
-            topic = Topic(topic_id=row[0], area_id=row[1], title=row[2], summary=row[3],
-                          created=_text_to_datetime(row[4]), my_rating=row[5], ai_rating=row[6], ai_analysis=row[7],
-                          read=_int_to_bool(row[8]), saved=_int_to_bool(row[9]))
-            topics.append(topic)
-        return topics
+        return self._iter_rows(sql, _row_to_topic, data)
 
     # endregion
 
@@ -401,32 +625,107 @@ class DatabaseService:
                 (?, ?) 
         """
         data = (post_id, topic_id)
-        self._execute_sql(sql, data)
+        with self.transaction():
+            number_of_links = self._execute_sql(sql, data).rowcount
+            self._execute_sql("""
+                DELETE FROM pending_posts
+                WHERE post_id = ? AND area_id = (SELECT topics.area_id FROM topics WHERE topics.id = ?)
+            """, data)
+            # Duplicates of the post follow it into every topic of an area their feed belongs to
+            self._execute_sql("""
+                INSERT OR IGNORE INTO posts_x_topics(post_id, topic_id)
+                SELECT posts.id, topics.id
+                FROM posts
+                JOIN topics ON topics.id = ?
+                JOIN areas_x_rss_feeds ON areas_x_rss_feeds.rss_feed_id = posts.rss_feed_id
+                    AND areas_x_rss_feeds.area_id = topics.area_id
+                WHERE posts.duplicate_of = ?
+            """, (topic_id, post_id))
+            # The post counts of existing topics change when posts are matched to them later
+            if number_of_links > 0:
+                self._bump_data_version()
+
+    # endregion
+
+    # region PostSignature
+
+    def add_post_signature(self, post_id: int, signature: bytes, buckets: list[tuple[int, int]]):
+        with self.transaction():
+            self._execute_sql("INSERT OR REPLACE INTO post_signatures(post_id, signature) VALUES(?, ?)",
+                              (post_id, signature))
+            self._execute_many_sql("INSERT OR IGNORE INTO post_buckets(band, bucket, post_id) VALUES(?, ?, ?)",
+                                   [(band, bucket, post_id) for band, bucket in buckets])
+
+    def get_signatures_by_buckets(self, buckets: list[tuple[int, int]]) -> dict[int, bytes]:
+        if len(buckets) < 1:
+            return {}
+        conditions = " OR ".join("(post_buckets.band = ? AND post_buckets.bucket = ?)" for _ in buckets)
+        self.cursor.execute(f"""
+            SELECT post_signatures.post_id, post_signatures.signature
+            FROM post_signatures
+            WHERE post_signatures.post_id IN (
+                SELECT post_buckets.post_id FROM post_buckets WHERE {conditions}
+            )
+        """, [value for bucket in buckets for value in bucket])
+        return {row[0]: row[1] for row in self.cursor.fetchall()}
+
+    def get_posts_without_signature(self, limit: int) -> list[Post]:
+        return self._get_posts("posts.id NOT IN (SELECT post_signatures.post_id FROM post_signatures)",
+                               f"id DESC LIMIT {limit}")
+
+    def mark_post_as_duplicate(self, post_id: int, original_post_id: int):
+        # Duplicates always point to the first post of the story, never to another duplicate
+        self.cursor.execute("SELECT IFNULL(duplicate_of, id) FROM posts WHERE id = ?", (original_post_id,))
+        original_post_id = self.cursor.fetchone()[0]
+        with self.transaction():
+            self._execute_sql("UPDATE posts SET duplicate_of = ? WHERE id = ?", (original_post_id, post_id))
+            # The duplicate does not need its own topic where the original is handled already ...
+            self._execute_sql("""
+                DELETE FROM pending_posts
+                WHERE post_id = ? AND area_id IN (
+                    SELECT areas_x_rss_feeds.area_id
+                    FROM areas_x_rss_feeds
+                    JOIN posts ON posts.rss_feed_id = areas_x_rss_feeds.rss_feed_id
+                    WHERE posts.id = ?
+                )
+            """, (post_id, original_post_id))
+            # ... and joins the topics the original already has in the areas of its feed
+            self._execute_sql("""
+                INSERT OR IGNORE INTO posts_x_topics(post_id, topic_id)
+                SELECT posts.id, topics.id
+                FROM posts
+                JOIN areas_x_rss_feeds ON areas_x_rss_feeds.rss_feed_id = posts.rss_feed_id
+                JOIN topics ON topics.area_id = areas_x_rss_feeds.area_id
+                JOIN posts_x_topics ON posts_x_topics.topic_id = topics.id AND posts_x_topics.post_id = ?
+                WHERE posts.id = ?
+            """, (original_post_id, post_id))
 
     # endregion
 
     # region RssFeed
     def add_rss_feed(self, rss_feed: RssFeed):
         sql = """
-            INSERT OR IGNORE INTO rss_feeds(link, web_link, title, last_update, last_error)
-            VALUES(?, ?, ?, ?, ?)
+            INSERT OR IGNORE INTO rss_feeds(link, web_link, title, last_update, last_error, etag, modified, content_hash)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?)
         """
         data = (rss_feed.link, rss_feed.web_link, rss_feed.title, _datetime_to_text(rss_feed.last_update),
-                rss_feed.last_error)
+                rss_feed.last_error, rss_feed.etag, rss_feed.modified, rss_feed.content_hash)
         cursor = self._execute_sql(sql, data)
         rss_feed.id = cursor.lastrowid
+        self._rss_feeds_by_id = None
 
     def update_rss_feed(self, rss_feed: RssFeed):
         sql = """
             UPDATE rss_feeds 
-            SET link=?, web_link=?, title=?, last_update=?, last_error=?
+            SET link=?, web_link=?, title=?, last_update=?, last_error=?, etag=?, modified=?, content_hash=?
             WHERE id=?
         """
         data = (
             rss_feed.link, rss_feed.web_link, rss_feed.title, _datetime_to_text(rss_feed.last_update),
-            rss_feed.last_error,
+            rss_feed.last_error, rss_feed.etag, rss_feed.modified, rss_feed.content_hash,
             rss_feed.id)
         self._execute_sql(sql, data)
+        self._rss_feeds_by_id = None
 
     def get_enabled_rss_feeds(self) -> list[RssFeed]:
         return self._get_rss_feeds(f"""
@@ -437,6 +736,17 @@ class DatabaseService:
             )
         """)
 
+    def get_rss_feed_publish_intervals(self, published_after: datetime) -> dict[int, float]:
+        # Average number of seconds between two posts of a feed, feeds with less than two posts have no rate yet
+        self.cursor.execute("""
+            SELECT rss_feed_id, (julianday(MAX(published)) - julianday(MIN(published))) * 86400.0 / (COUNT(*) - 1)
+            FROM posts
+            WHERE published >= ?
+            GROUP BY rss_feed_id
+            HAVING COUNT(*) > 1
+        """, (_datetime_to_text(published_after),))
+        return {row[0]: row[1] for row in self.cursor.fetchall()}
+
     def get_rss_feed_by_id(self, rss_feed_id: int) -> RssFeed | None:
         rss_feeds = self._get_rss_feeds(f"id={rss_feed_id}")
         if len(rss_feeds) < 1:
@@ -449,19 +759,18 @@ class DatabaseService:
             return None
         return rss_feeds[0]
 
+    def _get_rss_feeds_by_id(self) -> dict[int, RssFeed]:
+        # The table only holds a few dozen feeds, so it is loaded once and kept until a feed changes
+        if self._rss_feeds_by_id is None:
+            self._rss_feeds_by_id = {rss_feed.id: rss_feed for rss_feed in self._get_rss_feeds("1 = 1")}
+        return self._rss_feeds_by_id
+
     def _get_rss_feeds(self, where: str) -> list[RssFeed]:
-        self.cursor.execute(f"""
-            SELECT id, link, web_link, title, last_update, last_error
+        return list(self._iter_rows(f"""
+            SELECT id, link, web_link, title, last_update, last_error, etag, modified, content_hash
             FROM rss_feeds 
             WHERE {where}
-        """)
-        rows = self.cursor.fetchall()
-        rss_feeds = []
-        for row in rows:
-            rss_feed = RssFeed(rss_feed_id=row[0], link=row[1], web_link=row[2], title=row[3],
-                               last_update=_text_to_datetime(row[4]), last_error=row[5])
-            rss_feeds.append(rss_feed)
-        return rss_feeds
+        """, _row_to_rss_feed))
 
     def disable_all_rss_feeds(self):
         sql = "UPDATE areas_x_rss_feeds SET enabled = 0"
@@ -480,6 +789,187 @@ class DatabaseService:
                 VALUES(?, ?, ?, ?)
             """
             data = (area_id, rss_feed_id, priority, _bool_to_int(True))
-            self._execute_sql(sql, data)
+            with self.transaction():
+                self._execute_sql(sql, data)
+                # Posts already downloaded from the feed still need a topic in the newly linked area
+                self._add_pending_posts(f"posts.rss_feed_id = {rss_feed_id} AND areas_x_rss_feeds.area_id = {area_id}")
+
+    # endregion
+
+    # region AiResponse
+
+    def add_ai_response(self, key: str, response: str):
+        sql = """
+            INSERT OR REPLACE INTO ai_responses(key, response, created, size)
+            VALUES(?, ?, ?, ?)
+        """
+        data = (key, response, _datetime_to_text(datetime.now().astimezone(timezone.utc)), len(response))
+        self._execute_sql(sql, data)
+
+    def get_ai_response(self, key: str) -> str | None:
+        self.cursor.execute("SELECT response FROM ai_responses WHERE key = ?", (key,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def delete_ai_response(self, key: str):
+        self._execute_sql("DELETE FROM ai_responses WHERE key = ?", (key,))
+
+    def delete_old_ai_responses(self, created_before: datetime, max_total_size: int):
+        with self.transaction():
+            self._execute_sql("DELETE FROM ai_responses WHERE created < ?", (_datetime_to_text(created_before),))
+            # Keeps the newest responses which fit into max_total_size
+            self._execute_sql("""
+                DELETE FROM ai_responses
+                WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (ORDER BY created DESC, key) AS total_size
+                        FROM ai_responses
+                    )
+                    WHERE total_size > ?
+                )
+            """, (max_total_size,))
+
+    # endregion
+
+    # region DataVersion
+
+    def get_data_version(self) -> tuple[int, datetime]:
+        self.cursor.execute("SELECT version, updated FROM data_version WHERE id = 1")
+        row = self.cursor.fetchone()
+        return row[0], _text_to_datetime(row[1]).replace(tzinfo=timezone.utc)
+
+    def _bump_data_version(self):
+        # Called by every change visible in the web UI, the version is used as ETag of the topic pages
+        self._execute_sql("UPDATE data_version SET version = version + 1, updated = ? WHERE id = 1",
+                          (_datetime_to_text(datetime.now().astimezone(timezone.utc)),))
+
+    # endregion
+
+    # region Archive
+
+    def archive_topics(self, created_before: datetime) -> tuple[int, int]:
+        # Read topics which are not saved move to the archive together with their posts nothing else refers to.
+        # Posts shared with a topic that stays are copied, so the archived topic still has all its posts.
+        # Posts which never got a topic stay where they are.
+        self._attach_archive()
+        self._execute_sql("DROP TABLE IF EXISTS temp.archived_topic_ids")
+        self._execute_sql("DROP TABLE IF EXISTS temp.archived_post_ids")
+        with self.transaction():
+            self._execute_sql(f"""
+                CREATE TEMP TABLE archived_topic_ids AS
+                SELECT id FROM topics
+                WHERE read = {_bool_to_int(True)} AND IFNULL(saved, 0) = {_bool_to_int(False)} AND created < ?
+            """, (_datetime_to_text(created_before),))
+            self._execute_sql(f"""
+                CREATE TEMP TABLE archived_post_ids AS
+                SELECT posts.id FROM posts
+                WHERE IFNULL(posts.saved, 0) = {_bool_to_int(False)}
+                    AND NOT EXISTS (
+                        SELECT 1 FROM posts_x_topics
+                        WHERE posts_x_topics.post_id = posts.id
+                            AND posts_x_topics.topic_id NOT IN (SELECT id FROM temp.archived_topic_ids)
+                    )
+                    AND EXISTS (
+                        SELECT 1 FROM posts_x_topics
+                        WHERE posts_x_topics.post_id = posts.id
+                            AND posts_x_topics.topic_id IN (SELECT id FROM temp.archived_topic_ids)
+                    )
+            """)
+
+            self._execute_sql("""
+                INSERT OR IGNORE INTO archive.topics
+                    (id, area_id, title, summary, created, my_rating, ai_rating, ai_analysis, read, saved)
+                SELECT id, area_id, title, summary, created, my_rating, ai_rating, ai_analysis, read, saved
+                FROM topics
+                WHERE id IN (SELECT id FROM temp.archived_topic_ids)
+            """)
+            self._execute_sql("""
+                INSERT OR IGNORE INTO archive.posts
+                    (id, link, title, summary, published, created, rss_feed_id, ai_fileid, saved, duplicate_of)
+                SELECT id, link, title, summary, published, created, rss_feed_id, ai_fileid, saved, duplicate_of
+                FROM posts
+                WHERE id IN (SELECT id FROM temp.archived_post_ids) OR id IN (
+                    SELECT post_id FROM posts_x_topics WHERE topic_id IN (SELECT id FROM temp.archived_topic_ids)
+                )
+            """)
+            self._execute_sql("""
+                INSERT OR IGNORE INTO archive.posts_x_topics(post_id, topic_id)
+                SELECT post_id, topic_id
+                FROM posts_x_topics
+                WHERE topic_id IN (SELECT id FROM temp.archived_topic_ids)
+            """)
+            # The links stay known, so the feeds cannot bring archived posts back
+            self._execute_sql("""
+                INSERT OR IGNORE INTO archived_post_links(link)
+                SELECT link FROM posts WHERE id IN (SELECT id FROM temp.archived_post_ids)
+            """)
+
+            self._execute_sql("""
+                DELETE FROM posts_x_topics
+                WHERE topic_id IN (SELECT id FROM temp.archived_topic_ids)
+                    OR post_id IN (SELECT id FROM temp.archived_post_ids)
+            """)
+            self._execute_sql("DELETE FROM pending_posts WHERE post_id IN (SELECT id FROM temp.archived_post_ids)")
+            self._execute_sql("DELETE FROM post_signatures WHERE post_id IN (SELECT id FROM temp.archived_post_ids)")
+            self._execute_sql("DELETE FROM post_buckets WHERE post_id IN (SELECT id FROM temp.archived_post_ids)")
+            self._execute_sql("""
+                UPDATE posts SET duplicate_of = NULL
+                WHERE duplicate_of IN (SELECT id FROM temp.archived_post_ids)
+            """)
+            number_of_posts = self._execute_sql(
+                "DELETE FROM posts WHERE id IN (SELECT id FROM temp.archived_post_ids)").rowcount
+            number_of_topics = self._execute_sql(
+                "DELETE FROM topics WHERE id IN (SELECT id FROM temp.archived_topic_ids)").rowcount
+            if number_of_posts > 0 or number_of_topics > 0:
+                self._bump_data_version()
+        self._execute_sql("DROP TABLE temp.archived_topic_ids")
+        self._execute_sql("DROP TABLE temp.archived_post_ids")
+        return number_of_topics, number_of_posts
+
+    def compact(self):
+        # Returns the pages freed by deletions to the file system
+        self.cursor.execute("PRAGMA main.auto_vacuum")
+        if self.cursor.fetchone()[0] == 2:
+            self.cursor.execute("PRAGMA main.incremental_vacuum")
+            self.cursor.fetchall()
+        else:
+            # Databases created before incremental vacuum need one full VACUUM to switch
+            self.cursor.execute("PRAGMA main.auto_vacuum = INCREMENTAL")
+            self.cursor.execute("VACUUM main")
+
+    # endregion
+
+    # region Search
+
+    def search(self, text: str, limit: int, offset: int = 0, archive: bool = False) -> list[SearchResult]:
+        fts_query = _text_to_fts_query(text)
+        if len(fts_query) < 1:
+            return []
+        schema = "main"
+        if archive:
+            self._attach_archive()
+            schema = "archive"
+
+        # Matched terms are wrapped in SEARCH_MATCH_START / SEARCH_MATCH_END, which the web layer turns into markup
+        sql = f"""
+            SELECT 'topic', topics.id, topics.title,
+                snippet(topics_fts, -1, '{SEARCH_MATCH_START}', '{SEARCH_MATCH_END}', '…', 32),
+                bm25(topics_fts), NULL, topics.created
+            FROM {schema}.topics_fts AS topics_fts
+            JOIN {schema}.topics AS topics ON topics.id = topics_fts.rowid
+            WHERE topics_fts MATCH ?
+            UNION ALL
+            SELECT 'post', posts.id, posts.title,
+                snippet(posts_fts, -1, '{SEARCH_MATCH_START}', '{SEARCH_MATCH_END}', '…', 32),
+                bm25(posts_fts), posts.link, posts.published
+            FROM {schema}.posts_fts AS posts_fts
+            JOIN {schema}.posts AS posts ON posts.id = posts_fts.rowid
+            WHERE posts_fts MATCH ?
+            ORDER BY 5
+            LIMIT ? OFFSET ?
+        """
+        return list(self._iter_rows(sql, _row_to_search_result, (fts_query, fts_query, limit, offset)))
 
     # endregion
@@ -0,0 +1,151 @@
+import functools
+import inspect
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable
+
+
+# Known metrics with their Prometheus type and help text, anything else is rendered as untyped
+_METRIC_DESCRIPTIONS = {
+    "mentalist_feed_fetch_seconds": ("summary", "Time to download a feed"),
+    "mentalist_feed_parse_seconds": ("summary", "Time to parse a feed and clean up its new posts"),
+    "mentalist_feed_posts_seen_total": ("counter", "Posts listed by the feeds"),
+    "mentalist_feed_posts_new_total": ("counter", "Posts stored for the first time"),
+    "mentalist_feed_errors_total": ("counter", "Feeds which could not be fetched or parsed"),
+    "mentalist_database_seconds": ("summary", "Time spent in DatabaseService methods"),
+    "mentalist_llm_queue_wait_seconds": ("summary", "Time a batch waited for a free worker before its request"),
+    "mentalist_llm_run_seconds": ("summary", "Time from the first request of a batch to its response"),
+    "mentalist_llm_tokens_total": ("counter", "Tokens used by the OpenAI API"),
+    "mentalist_web_request_seconds": ("summary", "Time to answer a web request"),
+    "mentalist_web_render_seconds": ("summary", "Time to render a topic list page"),
+}
+
+_QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if len(labels) < 1:
+        return ""
+    return "{" + ",".join(f"{name}=\"{_escape_label_value(value)}\"" for name, value in labels) + "}"
+
+
+def _get_labels(labels: dict[str, object]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class _Summary:
+    def __init__(self, max_samples: int):
+        self.count = 0
+        self.sum = 0.0
+        # Quantiles come from the latest observations only, so memory stays bounded in long running processes
+        self.samples = deque(maxlen=max_samples)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def get_quantiles(self) -> list[tuple[float, float]]:
+        samples = sorted(self.samples)
+        if len(samples) < 1:
+            return []
+        return [(quantile, samples[min(int(quantile * len(samples)), len(samples) - 1)]) for quantile in _QUANTILES]
+
+
+class MetricsService:
+    def __init__(self, max_samples: int = 1024):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.summaries = {}
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = (name, _get_labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _get_labels(labels))
+        with self.lock:
+            summary = self.summaries.get(key)
+            if summary is None:
+                summary = self.summaries[key] = _Summary(self.max_samples)
+            summary.observe(value)
+
+    @contextmanager
+    def measure(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self.lock:
+            series_by_name = {}
+            for name, labels in list(self.counters) + list(self.summaries):
+                series_by_name.setdefault(name, []).append(labels)
+
+            for name in sorted(series_by_name):
+                kind, description = _METRIC_DESCRIPTIONS.get(name, ("untyped", None))
+                if description is not None:
+                    lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels in sorted(series_by_name[name]):
+                    if (name, labels) in self.counters:
+                        lines.append(f"{name}{_format_labels(labels)} {self.counters[(name, labels)]}")
+                        continue
+                    summary = self.summaries[(name, labels)]
+                    for quantile, value in summary.get_quantiles():
+                        quantile_labels = labels + (("quantile", str(quantile)),)
+                        lines.append(f"{name}{_format_labels(quantile_labels)} {value:.6f}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {summary.sum:.6f}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {summary.count}")
+        return "\n".join(lines) + "\n"
+
+    def get_summary(self) -> str:
+        # Human readable variant for the log, one line per series
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{_format_labels(labels)}: {value:g}")
+            for (name, labels), summary in sorted(self.summaries.items(), key=lambda item: item[0]):
+                quantiles = ", ".join(f"p{int(quantile * 100)}={value:.4f}s"
+                                      for quantile, value in summary.get_quantiles())
+                lines.append(f"{name}{_format_labels(labels)}: count={summary.count}, sum={summary.sum:.4f}s, "
+                             f"{quantiles}")
+        return "\n".join(lines)
+
+
+# One registry per process, shared by every service like the logging configuration
+metrics_service = MetricsService()
+
+
+def timed_methods(metric_name: str, exclude: tuple[str, ...] = ()) -> Callable[[type], type]:
+    # Wraps every public method of a class, the method name becomes the "method" label
+    def decorate(cls: type) -> type:
+        for name, value in list(vars(cls).items()):
+            if name.startswith("_") or name in exclude or not inspect.isfunction(value):
+                continue
+            setattr(cls, name, _timed(value, metric_name))
+        return cls
+    return decorate
+
+
+def _timed(function: Callable, metric_name: str) -> Callable:
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            metrics_service.observe(metric_name, time.perf_counter() - start, method=function.__name__)
+    return wrapper
@@ -0,0 +1,40 @@
+import re
+import zlib
+
+import numpy as np
+
+from services.config_service import ConfigService
+
+
+# Largest prime below 2^32
+_PRIME = np.uint64(4294967291)
+_NON_WORD_PATTERN = re.compile(r"\W+")
+
+
+class MinHashService:
+    def __init__(self, config_service: ConfigService):
+        self.config_service = config_service
+        # Fixed seed: signatures are stored, so the permutations must be the same in every run
+        random = np.random.default_rng(20240101)
+        self.a = random.integers(1, int(_PRIME), size=config_service.minhash_permutations, dtype=np.uint64)
+        self.b = random.integers(0, int(_PRIME), size=config_service.minhash_permutations, dtype=np.uint64)
+
+    def get_signature(self, text: str) -> np.ndarray:
+        normalized = _NON_WORD_PATTERN.sub(" ", text.lower()).strip()
+        size = self.config_service.minhash_shingle_size
+        shingles = {normalized[index:index + size] for index in range(max(1, len(normalized) - size + 1))}
+        hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles], dtype=np.uint64)
+
+        # a, b < _PRIME < 2^32 and hash < 2^32, so a * hash + b stays below 2^64 and cannot wrap in uint64.
+        # The crc32 hashes may be above _PRIME, which only folds a few of them onto the same values.
+        permuted = (np.outer(self.a, hashes) + self.b[:, None]) % _PRIME
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def get_buckets(self, signature: np.ndarray) -> list[tuple[int, int]]:
+        rows = self.config_service.minhash_rows_per_band
+        return [(band, zlib.crc32(signature[band * rows:(band + 1) * rows].tobytes()))
+                for band in range(len(signature) // rows)]
+
+    @staticmethod
+    def get_similarity(signature: np.ndarray, other_signature: np.ndarray) -> float:
+        return float(np.mean(signature == other_signature))
@@ -2,73 +2,174 @@ import hashlib
 import html
 import json
 import logging
+import threading
 import time
-from datetime import datetime, timezone
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterator
 
 from openai import OpenAI
 
 from model.area import Area
+from model.post import Post
 from model.topic import Topic
+from services.clustering_service import ClusteringService
 from services.config_service import ConfigService
 from services.database_service import DatabaseService
+from services.metrics_service import metrics_service
+
+
+_RUN_FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+def _read_instructions(area: Area) -> str:
+    with open(area.instructions_filename, 'r') as instructions_file:
+        return instructions_file.read()
+
+
+def _get_checksum(area: Area) -> str:
+    return hashlib.sha1((area.model + _read_instructions(area)).encode('utf-8')).hexdigest()
+
+
+def _get_response_cache_key(area: Area, checksum: str, user_message: str) -> str:
+    return hashlib.sha1((area.model + checksum + user_message).encode('utf-8')).hexdigest()
+
+
+def _post_to_json(post: Post, max_summary_length: int = None) -> str:
+    summary = post.summary if max_summary_length is None else post.summary[:max_summary_length]
+    formatted_post = "\t{"
+    formatted_post += f"\"ID\": \"{post.id}\", "
+    formatted_post += f"\"TITLE\": \"{html.escape(post.title)}\","
+    formatted_post += f"\"SUMMARY\": \"{html.escape(summary)}\""
+    formatted_post += "},\n"
+    return formatted_post
+
+
+def _posts_to_json(formatted_posts: list[str]) -> str:
+    return "{[\n" + "".join(formatted_posts) + "]}"
+
+
+def _add_token_usage(area: Area, usage: Any):
+    # Runs which did not complete carry no usage
+    if usage is None:
+        return
+    metrics_service.increment("mentalist_llm_tokens_total", usage.prompt_tokens, area=area.name, kind="prompt")
+    metrics_service.increment("mentalist_llm_tokens_total", usage.completion_tokens, area=area.name,
+                              kind="completion")
+
+
+class _RateLimiter:
+    def __init__(self, requests_per_minute: int):
+        self.interval = 60.0 / requests_per_minute
+        self.lock = threading.Lock()
+        self.next_request = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request)
+            self.next_request = request_time + self.interval
+        if request_time > now:
+            time.sleep(request_time - now)
 
 
 class OpenAiService:
-    def __init__(self, database_service: DatabaseService, config_service: ConfigService):
+    def __init__(self, database_service: DatabaseService, config_service: ConfigService, client: OpenAI = None):
         self.database_service = database_service
         self.config_service = config_service
-        self.client = OpenAI(
+        # Any object with the same interface can stand in for the API, the benchmarks use a local fake
+        self.client = client if client is not None else OpenAI(
             api_key=config_service.openai_api_key
         )
+        self.rate_limiter = _RateLimiter(config_service.openai_requests_per_minute)
+        self.clustering_service = ClusteringService(config_service)
 
-    def create_topics(self):
-        areas = self.database_service.get_enabled_areas()
+    def create_topics(self, areas: list[Area] = None):
+        if areas is None:
+            areas = self.database_service.get_enabled_areas()
         if areas is None:
             return
 
-        for area in areas:
-            logging.info(f"Creating topics for area \"{area}\"")
+        self.database_service.delete_old_ai_responses(
+            created_before=datetime.now().astimezone(timezone.utc) -
+            timedelta(hours=self.config_service.openai_response_cache_ttl_hours),
+            max_total_size=self.config_service.openai_response_cache_max_size)
 
-            while True:
-                user_message = self._get_posts_by_area_without_topic_json(area.id)
-                if user_message is None:
-                    break
+        # Runs are only waited for in the worker threads, topics are stored from this thread as the runs finish.
+        # Every post without a topic is put into exactly one batch, so no two runs work on the same posts.
+        with ThreadPoolExecutor(max_workers=self.config_service.openai_max_concurrent_runs) as executor:
+            futures = {}
+            for area in areas:
+                logging.info(f"Creating topics for area \"{area}\"")
 
-                logging.info(f"User message:\n{user_message}")
+                duplicate_post_ids = {}
+                user_messages = self._get_posts_by_area_without_topic_json(area, duplicate_post_ids)
+                if len(user_messages) < 1:
+                    continue
 
-                self._create_or_update_ai_assistant(area)
+                # Chat completions take the instructions with every request, only runs need an assistant
+                if area.completion_mode != "chat":
+                    self._create_or_update_ai_assistant(area)
+                checksum = _get_checksum(area)
 
-                responses = self._get_responses_from_json(area.ai_id, user_message)
-                if responses is None:
-                    break
+                for user_message in user_messages:
+                    logging.info(f"User message:\n{user_message}")
+                    cache_key = _get_response_cache_key(area, checksum, user_message)
 
-                for response in responses:
-                    try:
-                        topic = Topic(area_id=area.id, title=response["TOPIC_TITLE"], summary=response["TOPIC_SUMMARY"],
-                                      ai_analysis=response["TOPIC_ANALYSIS"], ai_rating=int(response["TOPIC_RATING"]),
-                                      created=datetime.now().astimezone(timezone.utc))
-                        self.database_service.add_topic(topic)
-                        logging.info(f"Topic \"{topic}\" created successfully")
+                    # A batch which was already answered, but whose topics were not stored, is replayed for free
+                    cached_response = self.database_service.get_ai_response(cache_key)
+                    if cached_response is not None:
+                        logging.info(f"Using cached OpenAI response for area \"{area}\"")
+                        self._add_topics(area, json.loads(cached_response), duplicate_post_ids, cache_key)
+                        continue
 
-                        post_ids = response["POST_IDs"].split(',')
-                        for post_id_as_str in post_ids:
-                            post_id = int(post_id_as_str)
-                            self.database_service.add_post_x_topic(post_id, topic.id)
-                            self.database_service.add_post_x_topic(post_id, topic.id)
+                    future = executor.submit(self._get_responses_from_json, area, user_message,
+                                             time.perf_counter())
+                    futures[future] = (area, cache_key, duplicate_post_ids)
 
-                    except Exception as e:
-                        logging.error(f"Error when assigning topic to response \"{response}\": {e}")
+            for future in as_completed(futures):
+                area, cache_key, duplicate_post_ids = futures[future]
+                try:
+                    responses = future.result()
+                except Exception as e:
+                    logging.error(f"Error when creating topics for area \"{area}\": {e}")
+                    continue
+                if responses is not None:
+                    self.database_service.add_ai_response(cache_key, json.dumps(responses))
+                    self._add_topics(area, responses, duplicate_post_ids, cache_key)
 
-    def _create_or_update_ai_assistant(self, area: Area):
+    def _add_topics(self, area: Area, responses: Any, duplicate_post_ids: dict[int, list[int]], cache_key: str):
+        # All topics of a batch are stored at once, so an interrupted batch leaves its posts untouched
+        # and the retry sends exactly the same batch, which is then found in the response cache.
+        # The cached response is removed together with the applied topics, posts it did not assign
+        # get a fresh request with the next run instead of the same answer again.
+        with self.database_service.transaction():
+            self.database_service.delete_ai_response(cache_key)
+            for response in responses:
+                try:
+                    topic = Topic(area_id=area.id, title=response["TOPIC_TITLE"], summary=response["TOPIC_SUMMARY"],
+                                  ai_analysis=response["TOPIC_ANALYSIS"], ai_rating=int(response["TOPIC_RATING"]),
+                                  created=datetime.now().astimezone(timezone.utc))
+                    self.database_service.add_topic(topic)
+                    logging.info(f"Topic \"{topic}\" created successfully")
 
-        with open(area.instructions_filename, 'r') as instructions_file:
-            # Read the entire file content into a string
-            instructions = instructions_file.read()
+                    post_ids = response["POST_IDs"].split(',')
+                    for post_id_as_str in post_ids:
+                        post_id = int(post_id_as_str)
+                        self.database_service.add_post_x_topic(post_id, topic.id)
+                        # Near-duplicates were only represented by this post in the request
+                        for duplicate_post_id in duplicate_post_ids.get(post_id, []):
+                            self.database_service.add_post_x_topic(duplicate_post_id, topic.id)
 
-        current_checksum = hashlib.sha1((area.model + instructions).encode('utf-8')).hexdigest()
+                except Exception as e:
+                    logging.error(f"Error when assigning topic to response \"{response}\": {e}")
+
+    def _create_or_update_ai_assistant(self, area: Area):
+        instructions = _read_instructions(area)
+        current_checksum = _get_checksum(area)
 
         if area.ai_id is None:
+            self.rate_limiter.wait()
             ai_assistant = self.client.beta.assistants.create(
                 name=area.name,
                 description=area.title,
@@ -85,6 +186,7 @@ class OpenAiService:
             self.database_service.update_area(area)
 
         elif area.checksum != current_checksum:
+            self.rate_limiter.wait()
             ai_assistant = self.client.beta.assistants.update(
                 assistant_id=area.ai_id,
                 instructions=instructions,
@@ -96,64 +198,160 @@ class OpenAiService:
             area.checksum = current_checksum
             self.database_service.update_area(area)
 
-    def _get_responses_from_json(self, ai_assistant_id: str, user_message: str) -> Any | None:
+    def _get_responses_from_json(self, area: Area, user_message: str, submitted: float = None) -> Any | None:
+        start = time.perf_counter()
+        if submitted is not None:
+            metrics_service.observe("mentalist_llm_queue_wait_seconds", start - submitted, area=area.name)
+        if area.completion_mode == "chat":
+            response_text = self._get_chat_completion_response(area, user_message)
+        else:
+            response_text = self._get_assistant_response(area, user_message)
+        duration = time.perf_counter() - start
+        metrics_service.observe("mentalist_llm_run_seconds", duration, area=area.name, mode=area.completion_mode)
+        logging.info(f"OpenAI response for area \"{area}\" ({area.completion_mode}) took {duration:.2f}s")
+
+        if response_text is None:
+            return None
+
+        response_json = response_text.replace("```json", "")
+        response_json = response_json.replace("```", "")
+        try:
+            return json.loads(response_json)
+        except Exception as e:
+            logging.error(f"Error when parsing response from \"{response_json}\": {e}")
+
+        return None
+
+    def _get_assistant_response(self, area: Area, user_message: str) -> str | None:
+        self.rate_limiter.wait()
         ai_thread = self.client.beta.threads.create()
 
+        self.rate_limiter.wait()
         self.client.beta.threads.messages.create(
             thread_id=ai_thread.id,
             content=user_message,
             role="user")
 
+        if area.completion_mode == "stream":
+            status = self._wait_for_run_stream(area, ai_thread.id)
+        else:
+            status = self._wait_for_run_polling(area, ai_thread.id)
+
+        if status != 'completed':
+            logging.error(f"OpenAI Run finished with status {status}")
+            return None
+
+        try:
+            self.rate_limiter.wait()
+            messages = self.client.beta.threads.messages.list(thread_id=ai_thread.id)
+            return messages.data[0].content[0].text.value
+        except Exception as e:
+            logging.error(f"Error when reading response text: {e}")
+            return None
+
+    def _wait_for_run_polling(self, area: Area, thread_id: str) -> str:
+        self.rate_limiter.wait()
         ai_run = self.client.beta.threads.runs.create(
-            thread_id=ai_thread.id,
-            assistant_id=ai_assistant_id
+            thread_id=thread_id,
+            assistant_id=area.ai_id
         )
 
+        # Most runs finish within a few seconds, so start polling often and back off for the long ones
+        poll_interval = self.config_service.openai_poll_initial_interval
         while True:
-            ai_run_retrieved = self.client.beta.threads.runs.retrieve(run_id=ai_run.id, thread_id=ai_thread.id)
-            if (ai_run_retrieved.status == 'completed' or
-                    ai_run_retrieved.status == 'failed' or
-                    ai_run_retrieved.status == 'expired' or
-                    ai_run_retrieved.status == 'cancelled'):
-                break
-            time.sleep(5)
-
-        if ai_run_retrieved.status == 'completed':
-            try:
-                messages = self.client.beta.threads.messages.list(thread_id=ai_thread.id)
-                response_json = messages.data[0].content[0].text.value.replace("```json", "")
-                response_json = response_json.replace("```", "")
-            except Exception as e:
-                logging.error(f"Error when reading response text: {e}")
-                return None
-            try:
-                return json.loads(response_json)
-            except Exception as e:
-                logging.error(f"Error when parsing response from \"{response_json}\": {e}")
-        else:
-            logging.error(f"OpenAI Run finished with status {ai_run_retrieved.status}")
+            self.rate_limiter.wait()
+            ai_run_retrieved = self.client.beta.threads.runs.retrieve(run_id=ai_run.id, thread_id=thread_id)
+            if ai_run_retrieved.status in _RUN_FINAL_STATUSES:
+                _add_token_usage(area, ai_run_retrieved.usage)
+                return ai_run_retrieved.status
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * self.config_service.openai_poll_backoff_factor,
+                                self.config_service.openai_poll_max_interval)
 
-        return None
+    def _wait_for_run_stream(self, area: Area, thread_id: str) -> str:
+        self.rate_limiter.wait()
+        events = self.client.beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=area.ai_id,
+            stream=True
+        )
 
-    def _get_posts_by_area_without_topic_json(self, area_id: int) -> str | None:
+        status = None
+        for event in events:
+            if event.event.startswith("thread.run.") and not event.event.startswith("thread.run.step."):
+                status = event.data.status
+                if status in _RUN_FINAL_STATUSES:
+                    _add_token_usage(area, event.data.usage)
+                    break
+        return status
+
+    def _get_chat_completion_response(self, area: Area, user_message: str) -> str | None:
+        self.rate_limiter.wait()
+        completion = self.client.chat.completions.create(
+            model=area.model,
+            messages=[
+                {"role": "system", "content": _read_instructions(area)},
+                {"role": "user", "content": user_message}
+            ]
+        )
+        _add_token_usage(area, completion.usage)
+        return completion.choices[0].message.content
+
+    def _get_posts_by_area_without_topic_json(self, area: Area, duplicate_post_ids: dict[int, list[int]]) -> list[str]:
         logging.debug("Getting list of posts to assign a topic")
-        posts = self.database_service.get_posts_by_area_without_topic(area_id)
-        logging.info(f"Found {len(posts)} posts without a topic")
 
-        if len(posts) < 1:
-            return None
+        # Summaries differ a lot in length, so batches are filled up to a token budget instead of a post count
+        token_budget = area.batch_token_budget or self.config_service.openai_batch_token_budget
+        chars_per_token = self.config_service.openai_chars_per_token
+
+        batches = []
+        formatted_posts = []
+        batch_tokens = 0
+        number_of_posts = 0
+        for post in self._get_posts_by_area_without_topic(area, duplicate_post_ids):
+            number_of_posts += 1
+            formatted_post = _post_to_json(post)
+            post_tokens = len(formatted_post) // chars_per_token + 1
+            if post_tokens > token_budget:
+                # A single post must never make the request oversized on its own
+                formatted_post = _post_to_json(post, max(0, len(post.summary) -
+                                                         (post_tokens - token_budget) * chars_per_token))
+                post_tokens = token_budget
+
+            if (len(formatted_posts) > 0 and
+                    (batch_tokens + post_tokens > token_budget or
+                     len(formatted_posts) >= self.config_service.openai_max_posts_per_batch)):
+                batches.append(_posts_to_json(formatted_posts))
+                formatted_posts = []
+                batch_tokens = 0
+
+            formatted_posts.append(formatted_post)
+            batch_tokens += post_tokens
+
+        if len(formatted_posts) > 0:
+            batches.append(_posts_to_json(formatted_posts))
+
+        number_of_duplicates = sum(len(post_ids) for post_ids in duplicate_post_ids.values())
+        logging.info(f"Skipped {number_of_duplicates} near-duplicate posts")
+        logging.info(f"Packed {number_of_posts} posts without a topic into {len(batches)} batch(es) of at most {token_budget} tokens")
+        return batches
+
+    def _get_posts_by_area_without_topic(self, area: Area, duplicate_post_ids: dict[int, list[int]]) -> Iterator[Post]:
+        # Pages through the pending posts by id, so every query only reads one batch worth of rows
+        last_post_id = 0
+        while True:
+            posts = self.database_service.get_posts_by_area_without_topic(
+                area.id, after_post_id=last_post_id, limit=self.config_service.openai_max_posts_per_batch)
+            if len(posts) < 1:
+                return
+            last_post_id = posts[-1].id
+
+            if not self.config_service.openai_cluster_similar_posts:
+                yield from posts
+                continue
 
-        batch_index = 0
-        formatted_posts = "{[\n"
-        for post in posts:
-            formatted_posts += "\t{"
-            formatted_posts += f"\"ID\": \"{post.id}\", "
-            formatted_posts += f"\"TITLE\": \"{html.escape(post.title)}\","
-            formatted_posts += f"\"SUMMARY\": \"{html.escape(post.summary)}\""
-            formatted_posts += "},\n"
-            batch_index += 1
-            if batch_index >= self.config_service.openai_posts_batch_size:
-                break
-
-        formatted_posts += "]}"
-        return formatted_posts
+            # Only the first post of a cluster is sent, the others get the topics assigned to it
+            for cluster in self.clustering_service.cluster_posts(posts):
+                if len(cluster) > 1:
+                    duplicate_post_ids[cluster[0].id] = [post.id for post in cluster[1:]]
+                yield cluster[0]
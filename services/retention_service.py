@@ -0,0 +1,24 @@
+import logging
+
+from datetime import datetime, timedelta, timezone
+
+from services.config_service import ConfigService
+from services.database_service import DatabaseService
+
+
+class RetentionService:
+    def __init__(self, database_service: DatabaseService, config_service: ConfigService):
+        self.database_service = database_service
+        self.config_service = config_service
+
+    def archive_old_topics(self):
+        if not self.config_service.retention_enabled:
+            return
+
+        created_before = (datetime.now().astimezone(timezone.utc) -
+                          timedelta(days=self.config_service.retention_topic_days))
+        number_of_topics, number_of_posts = self.database_service.archive_topics(created_before)
+        logging.info(f"Archived {number_of_topics} topic(s) and {number_of_posts} post(s) "
+                     f"created before {created_before:%Y-%m-%d}")
+        if number_of_topics > 0 or number_of_posts > 0:
+            self.database_service.compact()
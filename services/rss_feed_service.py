@@ -1,13 +1,24 @@
 import feedparser
+import gzip
+import hashlib
 import html
 import logging
+import time
+import urllib.error
+import urllib.request
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timezone
 
+import numpy as np
 from bs4 import BeautifulSoup
 
 from model.post import Post
+from model.rss_feed import RssFeed
+from services.config_service import ConfigService
 from services.database_service import DatabaseService
+from services.metrics_service import metrics_service
+from services.minhash_service import MinHashService
 
 
 def _remove_self_promotion(summary: str) -> str:
@@ -22,48 +33,216 @@ def _remove_html(summary: str) -> str:
     return soup.get_text(separator=' ', strip=True)
 
 
+class _FeedContent:
+    def __init__(self, content: bytes, headers: dict[str, str]):
+        self.content = content
+        self.headers = headers
+        self.content_hash = hashlib.sha1(content).hexdigest()
+
+
+class _ParsedFeed:
+    def __init__(self, rss_feed: RssFeed, feed_content: _FeedContent = None, entries: list = None,
+                 parse_seconds: float = 0.0):
+        # Without content the feed was not modified or failed, there is nothing left to process
+        self.rss_feed = rss_feed
+        self.feed_content = feed_content
+        self.entries = [] if entries is None else entries
+        self.parse_seconds = parse_seconds
+
+
+def _update_validators(rss_feed: RssFeed, feed_content: _FeedContent):
+    rss_feed.etag = feed_content.headers.get("etag")
+    rss_feed.modified = feed_content.headers.get("last-modified")
+    rss_feed.content_hash = feed_content.content_hash
+
+
 class RssFeedService:
-    def __init__(self, database_service: DatabaseService):
+    def __init__(self, database_service: DatabaseService, config_service: ConfigService):
         self.database_service = database_service
-
-    def add_latest_posts(self):
-        logging.debug("Getting list of RSS feeds")
-        rss_feeds = self.database_service.get_enabled_rss_feeds()
-        logging.info(f"Found {len(rss_feeds)} RSS feeds")
-        for rss_feed in rss_feeds:
-            try:
-                rss_feed.last_update = datetime.now().astimezone(timezone.utc)
-
-                feed = feedparser.parse(rss_feed.link)
-
-                rss_feed.title = feed.feed.title
-                rss_feed.web_link = feed.feed.link
-
-                logging.info(f"Processing {len(feed.entries)} post(s) from \"{rss_feed}\"")
-
-                # Iterate through entries and print their titles and links
-                for entry in feed.entries:
-                    logging.debug(f"Processing post \"{entry.title}\"")
-
-                    if 'published_parsed' in entry:
-                        published = datetime(
-                            year=entry.published_parsed.tm_year,
-                            month=entry.published_parsed.tm_mon,
-                            day=entry.published_parsed.tm_mday,
-                            hour=entry.published_parsed.tm_hour,
-                            minute=entry.published_parsed.tm_min,
-                            second=entry.published_parsed.tm_sec
-                        )
+        self.config_service = config_service
+        self.minhash_service = MinHashService(config_service)
+        # New posts get their signature when they are stored, once the backfill is complete it never runs again
+        self._signatures_complete = False
+
+    def add_latest_posts(self, rss_feeds: list[RssFeed] = None) -> int:
+        if rss_feeds is None:
+            logging.debug("Getting list of RSS feeds")
+            rss_feeds = self.database_service.get_enabled_rss_feeds()
+            logging.info(f"Found {len(rss_feeds)} RSS feeds")
+        self._add_missing_signatures()
+
+        # Fetching, parsing and the clean-up of new posts run in the worker threads. The lookup of the known
+        # links and all writes stay in this thread, so the SQLite connection is only ever used by its owner.
+        number_of_new_posts = 0
+        with ThreadPoolExecutor(max_workers=self.config_service.rss_feeds_fetch_workers) as executor:
+            fetch_futures = {executor.submit(self._fetch_feed, rss_feed) for rss_feed in rss_feeds}
+            futures = set(fetch_futures)
+            while len(futures) > 0:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in fetch_futures:
+                        parsed_feed = future.result()
+                        known_links = self.database_service.get_known_post_links(
+                            [entry.link for entry in parsed_feed.entries if 'link' in entry])
+                        futures.add(executor.submit(self._get_posts, parsed_feed, known_links))
                     else:
-                        published = None
-                    post = Post(entry.link, html.unescape(entry.title),
-                                _remove_html(_remove_self_promotion(html.unescape(entry.summary))),
-                                published, rss_feed.id)
-                    self.database_service.add_post(post)
-
+                        number_of_new_posts += self._add_posts(*future.result())
+        return number_of_new_posts
+
+    def _add_posts(self, rss_feed: RssFeed, posts: list[Post]) -> int:
+        try:
+            with self.database_service.transaction():
+                new_posts = self.database_service.add_posts(posts)
+                number_of_duplicates = self._flag_duplicate_posts(new_posts)
+                self.database_service.update_rss_feed(rss_feed)
+        except Exception as e:
+            # The transaction was rolled back, validators included, so the next run fetches the feed in full
+            rss_feed.last_error = f"{e}"
+            metrics_service.increment("mentalist_feed_errors_total", feed=rss_feed.link)
+            logging.error(f"Error when storing posts of RSS feed \"{rss_feed}\": {e}")
+            return 0
+        metrics_service.increment("mentalist_feed_posts_new_total", len(new_posts), feed=rss_feed.link)
+        if len(posts) > 0:
+            logging.info(f"Added {len(new_posts)} new post(s) from \"{rss_feed}\", "
+                         f"{number_of_duplicates} of them near-duplicate(s)")
+        return len(new_posts)
+
+    def _add_missing_signatures(self):
+        # Posts stored before duplicate detection existed get their signatures, newest first
+        if self._signatures_complete:
+            return
+        posts = self.database_service.get_posts_without_signature(self.config_service.minhash_backfill_limit)
+        if len(posts) < 1:
+            self._signatures_complete = True
+            return
+        logging.info(f"Adding MinHash signatures to {len(posts)} existing post(s)")
+        with self.database_service.transaction():
+            for post in posts:
+                signature = self.minhash_service.get_signature(f"{post.title} {post.summary}")
+                self.database_service.add_post_signature(post.id, signature.tobytes(),
+                                                         self.minhash_service.get_buckets(signature))
+        # A partial page was the last one
+        self._signatures_complete = len(posts) < self.config_service.minhash_backfill_limit
+
+    def _flag_duplicate_posts(self, posts: list[Post]) -> int:
+        # Candidates share at least one LSH band with the post, so only a few signatures are compared
+        threshold = self.config_service.minhash_similarity_threshold
+        number_of_duplicates = 0
+        for post in posts:
+            buckets = self.minhash_service.get_buckets(post.signature)
+            candidates = self.database_service.get_signatures_by_buckets(buckets)
+            best_post_id, best_similarity = None, threshold
+            for candidate_post_id, candidate_signature in candidates.items():
+                similarity = self.minhash_service.get_similarity(
+                    post.signature, np.frombuffer(candidate_signature, dtype=np.uint32))
+                if similarity >= best_similarity:
+                    best_post_id, best_similarity = candidate_post_id, similarity
+
+            if best_post_id is not None:
+                logging.debug(f"Post \"{post}\" is a near-duplicate of post {best_post_id}")
+                self.database_service.mark_post_as_duplicate(post.id, best_post_id)
+                number_of_duplicates += 1
+            self.database_service.add_post_signature(post.id, post.signature.tobytes(), buckets)
+        return number_of_duplicates
+
+    def _fetch_feed(self, rss_feed: RssFeed) -> _ParsedFeed:
+        try:
+            rss_feed.last_update = datetime.now().astimezone(timezone.utc)
+
+            with metrics_service.measure("mentalist_feed_fetch_seconds", feed=rss_feed.link):
+                feed_content = self._download_feed(rss_feed)
+            if feed_content is None:
+                logging.info(f"RSS feed \"{rss_feed}\" not modified")
                 rss_feed.last_error = None
-            except Exception as e:
-                rss_feed.last_error = f"{e}"
-                logging.error(f"Error when parsing RSS feed \"{rss_feed}\": {e}")
-
-            self.database_service.update_rss_feed(rss_feed)
+                return _ParsedFeed(rss_feed)
+            if feed_content.content_hash == rss_feed.content_hash:
+                logging.info(f"RSS feed \"{rss_feed}\" content unchanged")
+                _update_validators(rss_feed, feed_content)
+                rss_feed.last_error = None
+                return _ParsedFeed(rss_feed)
+
+            parse_start = time.perf_counter()
+            feed = feedparser.parse(feed_content.content, response_headers=feed_content.headers)
+            metrics_service.increment("mentalist_feed_posts_seen_total", len(feed.entries), feed=rss_feed.link)
+
+            rss_feed.title = feed.feed.title
+            rss_feed.web_link = feed.feed.link
+            return _ParsedFeed(rss_feed, feed_content, feed.entries, time.perf_counter() - parse_start)
+        except Exception as e:
+            self._set_error(rss_feed, e)
+            return _ParsedFeed(rss_feed)
+
+    def _get_posts(self, parsed_feed: _ParsedFeed, known_links: set[str]) -> tuple[RssFeed, list[Post]]:
+        rss_feed = parsed_feed.rss_feed
+        posts = []
+        if parsed_feed.feed_content is None:
+            return rss_feed, posts
+        try:
+            clean_up_start = time.perf_counter()
+            # Already stored posts would be ignored by the INSERT anyway, so skip the text clean-up for them
+            entries = [entry for entry in parsed_feed.entries if entry.link not in known_links]
+            logging.info(f"Processing {len(entries)} of {len(parsed_feed.entries)} post(s) from \"{rss_feed}\"")
+
+            for entry in entries:
+                logging.debug(f"Processing post \"{entry.title}\"")
+
+                if 'published_parsed' in entry:
+                    published = datetime(
+                        year=entry.published_parsed.tm_year,
+                        month=entry.published_parsed.tm_mon,
+                        day=entry.published_parsed.tm_mday,
+                        hour=entry.published_parsed.tm_hour,
+                        minute=entry.published_parsed.tm_min,
+                        second=entry.published_parsed.tm_sec
+                    )
+                else:
+                    published = None
+                # All posts of a fetch share its timestamp instead of asking the clock for every post
+                post = Post(entry.link, html.unescape(entry.title),
+                            _remove_html(_remove_self_promotion(html.unescape(entry.summary))),
+                            published, rss_feed.id, created=rss_feed.last_update)
+                post.signature = self.minhash_service.get_signature(f"{post.title} {post.summary}")
+                posts.append(post)
+
+            metrics_service.observe("mentalist_feed_parse_seconds",
+                                    parsed_feed.parse_seconds + time.perf_counter() - clean_up_start,
+                                    feed=rss_feed.link)
+
+            # Validators are only stored once the content was processed, so a failed run is retried in full.
+            _update_validators(rss_feed, parsed_feed.feed_content)
+            rss_feed.last_error = None
+        except Exception as e:
+            self._set_error(rss_feed, e)
+
+        return rss_feed, posts
+
+    @staticmethod
+    def _set_error(rss_feed: RssFeed, error: Exception):
+        rss_feed.last_error = f"{error}"
+        metrics_service.increment("mentalist_feed_errors_total", feed=rss_feed.link)
+        logging.error(f"Error when parsing RSS feed \"{rss_feed}\": {error}")
+
+    def _download_feed(self, rss_feed: RssFeed) -> _FeedContent | None:
+        request = urllib.request.Request(rss_feed.link, headers={
+            "User-Agent": feedparser.USER_AGENT,
+            "Accept-Encoding": "gzip"
+        })
+        if rss_feed.etag is not None:
+            request.add_header("If-None-Match", rss_feed.etag)
+        if rss_feed.modified is not None:
+            request.add_header("If-Modified-Since", rss_feed.modified)
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.config_service.rss_feeds_fetch_timeout) as response:
+                content = response.read()
+                headers = {key.lower(): value for key, value in response.headers.items()}
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+
+        if headers.get("content-encoding") == "gzip":
+            content = gzip.decompress(content)
+            del headers["content-encoding"]
+        headers["content-location"] = rss_feed.link
+        return _FeedContent(content, headers)
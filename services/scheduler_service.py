@@ -0,0 +1,137 @@
+import logging
+import os
+import time
+
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+from model.area import Area
+from model.rss_feed import RssFeed
+from services.config_service import ConfigService
+from services.database_service import DatabaseService
+from services.openai_service import OpenAiService
+from services.retention_service import RetentionService
+from services.rss_feed_service import RssFeedService
+from services.topic_matching_service import TopicMatchingService
+
+
+def _as_utc(datetime_value: datetime) -> datetime:
+    # The database stores UTC without an offset
+    return datetime_value.replace(tzinfo=timezone.utc)
+
+
+class SchedulerService:
+    def __init__(self, database_service: DatabaseService, config_service: ConfigService,
+                 rss_feed_service: RssFeedService, topic_matching_service: TopicMatchingService,
+                 openai_service: OpenAiService, retention_service: RetentionService,
+                 load_areas: Callable[[], list[Area]]):
+        self.database_service = database_service
+        self.config_service = config_service
+        self.rss_feed_service = rss_feed_service
+        self.topic_matching_service = topic_matching_service
+        self.openai_service = openai_service
+        self.retention_service = retention_service
+        self.load_areas = load_areas
+        self._areas_modified = None
+        self._next_fetches = {}
+        self._next_retention = None
+
+    def run(self):
+        logging.info("Scheduler started")
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                # One failing feed, request or locked database must not stop the daemon, the next tick retries
+                logging.exception("Scheduler tick failed")
+            time.sleep(self._get_sleep_seconds())
+
+    def run_once(self):
+        self._import_areas_if_modified()
+
+        rss_feeds = self._get_due_rss_feeds()
+        if len(rss_feeds) > 0:
+            logging.info(f"Fetching {len(rss_feeds)} due RSS feed(s)")
+            if self.rss_feed_service.add_latest_posts(rss_feeds) > 0:
+                self.topic_matching_service.assign_posts_to_recent_topics()
+            self._schedule_rss_feeds(rss_feeds)
+
+        areas = self._get_due_areas()
+        if len(areas) > 0:
+            self.openai_service.create_topics(areas)
+
+        now = datetime.now().astimezone(timezone.utc)
+        if self._next_retention is None or self._next_retention <= now:
+            self.retention_service.archive_old_topics()
+            self._next_retention = now + timedelta(hours=self.config_service.retention_interval_hours)
+
+    def _import_areas_if_modified(self):
+        areas_modified = os.path.getmtime(self.config_service.areas_filename)
+        if areas_modified == self._areas_modified:
+            return
+        logging.info(f"Importing areas from \"{self.config_service.areas_filename}\"")
+        self.database_service.import_areas(self.load_areas())
+        self._areas_modified = areas_modified
+
+    def _get_due_rss_feeds(self) -> list[RssFeed]:
+        now = datetime.now().astimezone(timezone.utc)
+        rss_feeds = self.database_service.get_enabled_rss_feeds()
+        self._next_fetches = {rss_feed.id: self._next_fetches[rss_feed.id] for rss_feed in rss_feeds
+                              if rss_feed.id in self._next_fetches}
+
+        # After a restart a feed is not fetched again before its interval has passed
+        unscheduled_rss_feeds = [rss_feed for rss_feed in rss_feeds
+                                 if rss_feed.id not in self._next_fetches and rss_feed.last_update is not None]
+        if len(unscheduled_rss_feeds) > 0:
+            publish_intervals = self._get_publish_intervals()
+            for rss_feed in unscheduled_rss_feeds:
+                self._next_fetches[rss_feed.id] = (_as_utc(rss_feed.last_update) +
+                                                   self._get_rss_feed_interval(rss_feed, publish_intervals))
+
+        return [rss_feed for rss_feed in rss_feeds if self._next_fetches.get(rss_feed.id, now) <= now]
+
+    def _schedule_rss_feeds(self, rss_feeds: list[RssFeed]):
+        now = datetime.now().astimezone(timezone.utc)
+        publish_intervals = self._get_publish_intervals()
+        for rss_feed in rss_feeds:
+            interval = self._get_rss_feed_interval(rss_feed, publish_intervals)
+            self._next_fetches[rss_feed.id] = now + interval
+            logging.debug(f"RSS feed \"{rss_feed}\" is fetched again in {interval}")
+
+    def _get_publish_intervals(self) -> dict[int, float]:
+        return self.database_service.get_rss_feed_publish_intervals(
+            datetime.now().astimezone(timezone.utc) - timedelta(days=self.config_service.scheduler_feed_history_days))
+
+    def _get_rss_feed_interval(self, rss_feed: RssFeed, publish_intervals: dict[int, float]) -> timedelta:
+        # A feed is polled a few times per expected post, feeds without history are polled as rarely as allowed
+        min_seconds = self.config_service.scheduler_feed_min_interval_minutes * 60
+        max_seconds = self.config_service.scheduler_feed_max_interval_minutes * 60
+        publish_interval = publish_intervals.get(rss_feed.id)
+        if publish_interval is None:
+            return timedelta(seconds=max_seconds)
+        seconds = publish_interval * self.config_service.scheduler_feed_interval_factor
+        return timedelta(seconds=min(max(seconds, min_seconds), max_seconds))
+
+    def _get_due_areas(self) -> list[Area]:
+        # An area gets new topics once enough posts are waiting, or once its oldest post has waited too long
+        oldest_allowed = (datetime.now().astimezone(timezone.utc) -
+                          timedelta(minutes=self.config_service.scheduler_topics_max_pending_age_minutes))
+        pending_posts_stats = self.database_service.get_pending_posts_stats()
+        areas = []
+        for area in self.database_service.get_enabled_areas():
+            if area.id not in pending_posts_stats:
+                continue
+            number_of_posts, oldest_created = pending_posts_stats[area.id]
+            if (number_of_posts >= self.config_service.scheduler_topics_min_pending_posts or
+                    _as_utc(oldest_created) <= oldest_allowed):
+                logging.info(f"Area \"{area}\" is due with {number_of_posts} pending post(s)")
+                areas.append(area)
+        return areas
+
+    def _get_sleep_seconds(self) -> float:
+        # Waking up at least every tick keeps the age trigger and changes to the areas file responsive
+        now = datetime.now().astimezone(timezone.utc)
+        seconds = float(self.config_service.scheduler_tick_seconds)
+        if len(self._next_fetches) > 0:
+            seconds = min(seconds, (min(self._next_fetches.values()) - now).total_seconds())
+        return max(seconds, 1.0)
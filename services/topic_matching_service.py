@@ -0,0 +1,78 @@
+import logging
+
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from model.area import Area
+from model.post import Post
+from model.topic import Topic
+from services.clustering_service import ClusteringService
+from services.config_service import ConfigService
+from services.database_service import DatabaseService
+
+
+def _get_topic_text(topic: Topic) -> str:
+    # The posts carry the wording the sources use, which the topic summary often paraphrases
+    return " ".join([topic.title, topic.summary] + [f"{post.title} {post.summary}" for post in topic.posts])
+
+
+class TopicMatchingService:
+    def __init__(self, database_service: DatabaseService, config_service: ConfigService):
+        self.database_service = database_service
+        self.config_service = config_service
+        self.clustering_service = ClusteringService(config_service)
+
+    def assign_posts_to_recent_topics(self, areas: list[Area] = None):
+        if not self.config_service.topic_matching_enabled:
+            return
+
+        if areas is None:
+            areas = self.database_service.get_enabled_areas()
+        created_after = (datetime.now().astimezone(timezone.utc) -
+                         timedelta(hours=self.config_service.topic_matching_window_hours))
+        for area in areas:
+            topics = self.database_service.get_recent_topics(area.id, created_after)
+            if len(topics) < 1:
+                continue
+
+            # The topics are vectorized once and their IDF weights the posts, so a backlog of pending posts
+            # is matched one page at a time instead of as one matrix
+            topic_texts = [_get_topic_text(topic) for topic in topics]
+            inverse_document_frequencies = self.clustering_service.get_inverse_document_frequencies(topic_texts)
+            topic_vectors = self.clustering_service.vectorize(topic_texts, inverse_document_frequencies)
+
+            number_of_posts = 0
+            number_of_assigned_posts = 0
+            last_post_id = 0
+            while True:
+                posts = self.database_service.get_posts_by_area_without_topic(
+                    area.id, after_post_id=last_post_id, limit=self.config_service.topic_matching_page_size)
+                if len(posts) < 1:
+                    break
+                last_post_id = posts[-1].id
+                number_of_posts += len(posts)
+                number_of_assigned_posts += self._assign_posts(posts, topics, topic_vectors,
+                                                               inverse_document_frequencies)
+
+            if number_of_posts > 0:
+                logging.info(f"Assigned {number_of_assigned_posts} of {number_of_posts} post(s) to recent topics "
+                             f"of area \"{area}\"")
+
+    def _assign_posts(self, posts: list[Post], topics: list[Topic], topic_vectors: np.ndarray,
+                      inverse_document_frequencies: np.ndarray) -> int:
+        post_vectors = self.clustering_service.vectorize([f"{post.title} {post.summary}" for post in posts],
+                                                         inverse_document_frequencies)
+        similarities = post_vectors @ topic_vectors.T
+        best_topic_indexes = similarities.argmax(axis=1)
+
+        number_of_assigned_posts = 0
+        with self.database_service.transaction():
+            for post_index, post in enumerate(posts):
+                topic_index = best_topic_indexes[post_index]
+                if similarities[post_index, topic_index] < self.config_service.topic_matching_similarity_threshold:
+                    continue
+                self.database_service.add_post_x_topic(post.id, topics[topic_index].id)
+                logging.debug(f"Post \"{post}\" assigned to recent topic \"{topics[topic_index]}\"")
+                number_of_assigned_posts += 1
+        return number_of_assigned_posts
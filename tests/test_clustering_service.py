@@ -0,0 +1,33 @@
+import unittest
+
+from model.post import Post
+from services.clustering_service import ClusteringService
+from services.config_service import ConfigService
+
+
+def _get_post(post_id: int, title: str, summary: str = "") -> Post:
+    return Post(link=f"https://example.com/{post_id}", title=title, summary=summary, published=None, rss_feed_id=1,
+                post_id=post_id)
+
+
+class ClusteringServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.clustering_service = ClusteringService(ConfigService())
+
+    def test_similar_posts_share_a_cluster(self):
+        posts = [_get_post(1, "Verstappen wins the Monaco Grand Prix"),
+                 _get_post(2, "Verstappen wins the Monaco Grand Prix again"),
+                 _get_post(3, "Ferrari signs a new driver")]
+        clusters = self.clustering_service.cluster_posts(posts)
+        self.assertEqual([[post.id for post in cluster] for cluster in clusters], [[1, 2], [3]])
+
+    def test_post_without_words_forms_its_own_cluster(self):
+        posts = [_get_post(1, "…"),
+                 _get_post(2, "Verstappen wins the Monaco Grand Prix"),
+                 _get_post(3, "Verstappen wins the Monaco Grand Prix")]
+        clusters = self.clustering_service.cluster_posts(posts)
+        self.assertEqual([[post.id for post in cluster] for cluster in clusters], [[1], [2, 3]])
+
+
+if __name__ == '__main__':
+    unittest.main()
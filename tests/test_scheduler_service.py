@@ -0,0 +1,40 @@
+import unittest
+
+from unittest import mock
+
+from services.config_service import ConfigService
+from services.scheduler_service import SchedulerService
+
+
+class _StopScheduler(Exception):
+    pass
+
+
+class SchedulerServiceTest(unittest.TestCase):
+    def test_run_survives_a_failing_tick(self):
+        scheduler_service = SchedulerService(database_service=None, config_service=ConfigService(),
+                                             rss_feed_service=None, topic_matching_service=None, openai_service=None,
+                                             retention_service=None, load_areas=list)
+        ticks = []
+
+        def run_once():
+            ticks.append(len(ticks))
+            if len(ticks) == 1:
+                raise RuntimeError("database is locked")
+
+        def sleep(seconds: float):
+            if len(ticks) >= 2:
+                raise _StopScheduler()
+
+        with mock.patch.object(scheduler_service, "run_once", side_effect=run_once), \
+                mock.patch("services.scheduler_service.time.sleep", side_effect=sleep), \
+                self.assertLogs(level="ERROR") as logs:
+            with self.assertRaises(_StopScheduler):
+                scheduler_service.run()
+
+        self.assertEqual(len(ticks), 2)
+        self.assertIn("Scheduler tick failed", logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()